@@ -15,7 +15,10 @@ from .fields import (
 
 from .models import Need, ModelNeed
 
-from .views.search import SearchHitView, ListView
+from .views.search import (
+    SearchHitView, ListView,
+    FederatedSearchHitView, FederatedListView
+)
 
 from .forms import TextInputForm, SearchForm
 
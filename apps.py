@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.utils.module_loading import autodiscover_modules
 
 
 class NeedConfig(AppConfig):
     name = 'need'
+
+    def ready(self):
+        # registers the OutboxEntry Model
+        from . import outbox
+
+        if (getattr(settings, 'NEED_WARM_UP', None) is not False):
+            # Need classes live in 'need' modules of apps
+            autodiscover_modules('need')
+            from .warmup import warm_up_registered
+            warm_up_registered()
+
+        from .segments import start_merge_scheduler
+        self.merge_scheduler = start_merge_scheduler()
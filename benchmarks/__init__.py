@@ -0,0 +1,6 @@
+'''
+Benchmarks for Need.
+Run each module from the folder above the app, e.g.
+
+    python -m need.benchmarks.parse
+'''
@@ -0,0 +1,68 @@
+'''
+Synthetic documents, shaped like the README's Firework example.
+Seeded, so a corpus is the same on every run.
+'''
+import random
+
+
+COLOURS = [
+    'red', 'blue', 'green', 'gold', 'silver', 'white', 'purple', 'orange',
+    'crimson', 'violet', 'amber', 'lime', 'pink', 'teal', 'copper',
+]
+SHAPES = [
+    'rocket', 'fountain', 'candle', 'wheel', 'mine', 'cake', 'shell',
+    'comet', 'star', 'spinner', 'sparkler', 'barrage', 'crossette',
+]
+EFFECTS = [
+    'peony', 'chrysanthemum', 'willow', 'palm', 'crackle', 'strobe',
+    'crossette', 'brocade', 'kamuro', 'horsetail', 'ring', 'spider',
+]
+MAKES = [
+    'NobelExplosives', 'Standard', 'Brock', 'Pains', 'Kimbolton',
+    'Epic', 'Jorge', 'Benwell', 'Zena', 'Black Cat',
+]
+WORDS = [
+    'drooping', 'splay', 'final', 'burst', 'trail', 'tail', 'glitter',
+    'loud', 'quiet', 'slow', 'fast', 'high', 'low', 'long', 'short',
+    'whistle', 'report', 'flash', 'smoke', 'hang', 'fade', 'break',
+]
+
+
+
+def firework(rnd, pk):
+    name = '{0} {1} {2}'.format(
+        rnd.choice(COLOURS).title(),
+        rnd.choice(COLOURS).title(),
+        rnd.choice(SHAPES).title()
+    )
+    description = ' '.join(rnd.choice(WORDS) for i in range(rnd.randint(6, 30)))
+    return {
+        'id': pk,
+        'name': name,
+        'description': description,
+        'effect': rnd.choice(EFFECTS),
+        'make': rnd.choice(MAKES),
+    }
+    
+def corpus(size, seed=0, start=1):
+    '''
+    List of document dicts, with pks from 'start'.
+    '''
+    rnd = random.Random(seed)
+    return [firework(rnd, pk) for pk in range(start, start + size)]
+
+def queries(count, seed=0):
+    '''
+    Search box text; single words, pairs, and quoted phrases.
+    '''
+    rnd = random.Random(seed)
+    b = []
+    for i in range(count):
+        kind = i % 3
+        if (kind == 0):
+            b.append(rnd.choice(SHAPES))
+        elif (kind == 1):
+            b.append('{0} {1}'.format(rnd.choice(COLOURS), rnd.choice(SHAPES)))
+        else:
+            b.append('"{0} {1}"'.format(rnd.choice(COLOURS), rnd.choice(COLOURS)))
+    return b
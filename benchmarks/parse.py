@@ -0,0 +1,62 @@
+'''
+Cost of query parsing, with and without ParserCache.
+Needs no Django setup, ::
+
+    python -m need.benchmarks.parse
+'''
+import time
+import argparse
+
+from whoosh.fields import Schema, TEXT, ID, KEYWORD
+from whoosh.qparser import SimpleParser
+
+from ..parsing import ParserCache
+
+
+SCHEMA = Schema(
+    id=ID(stored=True, unique=True),
+    name=TEXT(stored=True),
+    description=TEXT,
+    make=KEYWORD(stored=True),
+)
+
+# typed into a search box, one key at a time
+QUERIES = [
+    'f', 'fl', 'flo', 'flow', 'flower', 'flower r', 'flower ro', 'flower rocket',
+    'blue', 'blue star', '"blue star"', '"blue star" -red', 'roman candle',
+]
+
+
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for q in QUERIES:
+            fn(q)
+    return (time.perf_counter() - start) / (repeat * len(QUERIES))
+
+def run(repeat=200, fieldname='name'):
+    parsing = ParserCache(SCHEMA)
+    uncached = time_per_call(lambda q: SimpleParser(fieldname, SCHEMA).parse(q), repeat)
+    cached = time_per_call(lambda q: parsing.parse(fieldname, q), repeat)
+    return {
+        'queries': len(QUERIES),
+        'repeat': repeat,
+        'uncached_us': uncached * 1e6,
+        'cached_us': cached * 1e6,
+        'saved_us': (uncached - cached) * 1e6,
+    }
+    
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--repeat', type=int, default=200)
+    args = ap.parse_args()
+    r = run(args.repeat)
+    print('parse, new parser each call: {0:8.1f} us'.format(r['uncached_us']))
+    print('parse, through ParserCache:  {0:8.1f} us'.format(r['cached_us']))
+    print('saved per read:              {0:8.1f} us'.format(r['saved_us']))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+'''
+Throughput and latency of Need managers, and SearchHitView.
+Self-contained; configures Django with a temporary database and
+index folder. Writes results as JSON, ::
+
+    python -m need.benchmarks.suite --sizes 1000 10000 --threads 1 4 --out bench.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+
+
+MANAGERS = ['Manager', 'BlockingManager', 'ManagerManager', 'BlockingManagerManager']
+
+
+
+def setup(tmp):
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmark',
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.staticfiles',
+            'need',
+        ],
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(tmp, 'db.sqlite3'),
+        }},
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'loaders': [
+                    # search_hits.html extends a site's base.html
+                    ('django.template.loaders.locmem.Loader', {
+                        'base.html': '{% block header %}{% endblock %}{% block content %}{% endblock %}{% block footer %}{% endblock %}',
+                    }),
+                    'django.template.loaders.app_directories.Loader',
+                ],
+            },
+        }],
+        STATIC_URL='/static/',
+        WHOOSH=os.path.join(tmp, 'whoosh'),
+        USE_TZ=False,
+    )
+    os.mkdir(settings.WHOOSH)
+    django.setup()
+
+def firework_model():
+    from django.db import models, connection
+
+    class Firework(models.Model):
+        name = models.CharField(max_length=128)
+        description = models.TextField()
+        effect = models.CharField(max_length=64)
+        make = models.CharField(max_length=64)
+
+        class Meta:
+            app_label = 'need'
+
+    with connection.schema_editor() as editor:
+        editor.create_model(Firework)
+    return Firework
+
+def firework_need(model, manager_class, need_index, shards=1):
+    from need import ModelNeed, TextField, IdField
+
+    class Meta:
+        pass
+    Meta.model = model
+    Meta.need_index = need_index
+    Meta.fields = ['name', 'description', 'effect', 'make']
+    Meta.shards = shards
+    return type('FireworkNeed', (ModelNeed,), {
+        '__module__': __name__,
+        'name': TextField(stored=True, field_boost=2.0),
+        'description': TextField(),
+        'effect': IdField(),
+        'make': IdField(stored=True),
+        'actions': manager_class(),
+        'Meta': Meta,
+    })
+
+def search_view(need):
+    from need import SearchHitView
+
+    class FireworkSearchView(SearchHitView):
+        def indexdata_to_renderdata(self, result):
+            return {'url': '/firework/{0}'.format(result['id']), 'title': result['name'], 'teaser': result['make']}
+
+    return FireworkSearchView.as_view(need=need, search_fields='name')
+
+
+
+def percentile(ordered, q):
+    if (not ordered):
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summary(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    done = len(ordered)
+    return {
+        'count': done,
+        'errors': errors,
+        'seconds': elapsed,
+        'ops_per_sec': done / elapsed if elapsed else None,
+        'latency': {
+            'mean': sum(ordered) / done if done else None,
+            'p50': percentile(ordered, 0.5),
+            'p95': percentile(ordered, 0.95),
+            'p99': percentile(ordered, 0.99),
+            'max': ordered[-1] if ordered else None,
+        },
+    }
+
+def run_ops(fn, items, threads):
+    '''
+    Run fn on each item, split over threads. Failures are counted,
+    not raised; unsafe managers fail under threads.
+    '''
+    def worker(chunk):
+        latencies = []
+        errors = 0
+        for item in chunk:
+            start = time.perf_counter()
+            try:
+                fn(item)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        return latencies, errors
+
+    chunks = [items[i::threads] for i in range(threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as ex:
+        outs = list(ex.map(worker, chunks))
+    elapsed = time.perf_counter() - start
+    return summary([l for lats, e in outs for l in lats], sum(e for lats, e in outs), elapsed)
+
+def run_once(fn):
+    return run_ops(lambda item: fn(), [None], 1)
+
+
+
+def bench_manager(model, manager_name, size, threads_list, ops, shards, seed):
+    from django.test import RequestFactory
+    from need import managers
+    from need.benchmarks.corpus import corpus, queries
+
+    manager_class = getattr(managers, manager_name)
+    need = firework_need(
+        model,
+        manager_class,
+        'bench_{0}_{1}'.format(manager_name, size),
+        shards if (manager_name == 'ShardedManager') else 1
+    )
+    actions = need.actions
+    docs = corpus(size, seed)
+    b = []
+
+    def record(op, threads, result):
+        result.update({'manager': manager_name, 'size': size, 'threads': threads, 'op': op})
+        b.append(result)
+
+    record('bulk_add', 1, run_once(lambda: actions.bulk_add(docs)))
+    if (hasattr(actions, 'load')):
+        model.objects.all().delete()
+        model.objects.bulk_create(model(**d) for d in docs)
+        actions.clear()
+        record('load', 1, run_once(lambda: actions.load(batch_size=10000)))
+
+    view = search_view(need)
+    factory = RequestFactory()
+    texts = queries(ops, seed)
+
+    def view_request(text):
+        view(factory.get('/', {'search': text})).render()
+
+    next_pk = size + 1
+    for threads in threads_list:
+        added = corpus(ops, seed + threads, next_pk)
+        next_pk += ops
+        record('add', threads, run_ops(actions.add, added, threads))
+        record('merge', threads, run_ops(actions.merge, docs[:ops], threads))
+        record('read', threads, run_ops(lambda q: actions.read('name', q, len), texts, threads))
+        record('search_hit_view', threads, run_ops(view_request, texts, threads))
+        record('delete', threads, run_ops(actions.delete, [d['id'] for d in added], threads))
+    if (hasattr(actions, 'flush')):
+        actions.flush()
+    return b
+
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='corpus sizes')
+    ap.add_argument('--threads', type=int, nargs='+', default=[1, 4], help='thread counts')
+    ap.add_argument('--ops', type=int, default=200, help='operations per timed run')
+    ap.add_argument('--managers', nargs='+', default=MANAGERS, help='manager class names')
+    ap.add_argument('--shards', type=int, default=4, help='shards, for ShardedManager')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--out', default='-', help="JSON file, or '-' for stdout")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='need-bench-')
+    try:
+        setup(tmp)
+        import whoosh
+        from need import __version__
+        model = firework_model()
+        results = []
+        for size in args.sizes:
+            for manager_name in args.managers:
+                print('{0}, {1} documents'.format(manager_name, size), file=sys.stderr)
+                results.extend(bench_manager(model, manager_name, size, args.threads, args.ops, args.shards, args.seed))
+        report = {
+            'meta': {
+                'need': __version__,
+                'whoosh': whoosh.versionstring(),
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'args': vars(args),
+            },
+            'results': results,
+        }
+        text = json.dumps(report, indent=2)
+        if (args.out == '-'):
+            print(text)
+        else:
+            with open(args.out, 'w') as f:
+                f.write(text)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import time
+import threading
+import hashlib
+from collections import OrderedDict
+
+
+
+def normalise_query(query):
+    '''
+    Query text, with surrounding and repeated whitespace removed.
+    '''
+    return ' '.join(query.split())
+
+
+
+class ResultCache():
+    '''
+    Cache of search results, for a manager.
+    Stores the top hits for a search as a ranked list of dicts of
+    stored fields, with the count of all hits. Entries are marked
+    with the index version (build folder and generation) they were
+    read from, and are ignored once the index changes. Memory is 
+    bounded by LRU and TTL eviction.
+    A Django cache can be added as a shared tier, behind the local
+    cache. Then results are shared between processes.
+
+    @param max_entries most entries held locally. Least recently used are evicted.
+    @param ttl seconds an entry lives.
+    @param fields stored fields to keep for each hit. Default is all.
+    @param backend alias of a Django cache, or a cache object, used as a shared tier
+    '''
+    def __init__(self, max_entries=1024, ttl=300, fields=None, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fields = fields
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _backend(self):
+        if (isinstance(self.backend, str)):
+            from django.core.cache import caches
+            self.backend = caches[self.backend]
+        return self.backend
+
+    def _backend_key(self, key):
+        return 'need:' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def project(self, fields):
+        if (self.fields is None):
+            return fields
+        return {f : fields[f] for f in self.fields if f in fields}
+
+    def get(self, key, generation):
+        '''
+        Cached value, or None.
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None):
+                expires, gen, value = entry
+                if (expires > now and gen == generation):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+        if (self.backend is not None):
+            entry = self._backend().get(self._backend_key(key))
+            if (entry is not None and entry[0] == generation):
+                self._set_local(key, generation, entry[1], now)
+                with self._lock:
+                    self.hits += 1
+                return entry[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _set_local(self, key, generation, value, now):
+        with self._lock:
+            self._entries[key] = (now + self.ttl, generation, value)
+            self._entries.move_to_end(key)
+            while (len(self._entries) > self.max_entries):
+                self._entries.popitem(last=False)
+
+    def set(self, key, generation, value):
+        self._set_local(key, generation, value, time.time())
+        if (self.backend is not None):
+            self._backend().set(self._backend_key(key), (generation, value), self.ttl)
+
+    def clear(self):
+        '''
+        Empty the local cache. The shared tier is left.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,116 @@
+import hashlib
+from operator import attrgetter
+from datetime import date, datetime
+from decimal import Decimal
+from whoosh.fields import NUMERIC, DATETIME, BOOLEAN, STORED, COLUMN
+from whoosh.columns import FixedBytesColumn
+
+
+# Field holding document digests, when Meta.digests is set
+DIGEST_FIELD = 'need_digest'
+DIGEST_SIZE = 8
+
+def digest_field():
+    return COLUMN(FixedBytesColumn(DIGEST_SIZE))
+
+def document_digest(doc):
+    '''
+    Short hash of the values of a document.
+    '''
+    return hashlib.blake2b(repr(tuple(doc.items())).encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+
+def _to_datetime(v):
+    if (isinstance(v, datetime)):
+        return v
+    if (isinstance(v, date)):
+        return datetime(v.year, v.month, v.day)
+    return datetime.fromisoformat(str(v))
+
+def _to_bool(v):
+    if (isinstance(v, str)):
+        return v.lower() in BOOLEAN.trues
+    return bool(v)
+
+def _passthrough(v):
+    return v
+    
+def field_converter(field):
+    '''
+    Guess how to coerce values for a Whoosh field.
+    Numeric fields get native numbers, date fields get datetimes,
+    boolean fields get bools. Stored and column fields take 
+    anything. Other fields are text-like, and get strings.
+    
+    @param field a Whoosh field
+    '''
+    # DATETIME is a NUMERIC, so test first
+    if (isinstance(field, DATETIME)):
+        return _to_datetime
+    if (isinstance(field, NUMERIC)):
+        if (field.decimal_places):
+            return lambda v: v if isinstance(v, Decimal) else Decimal(str(v))
+        numtype = field.numtype
+        return lambda v: v if type(v) is numtype else numtype(v)
+    if (isinstance(field, BOOLEAN)):
+        return _to_bool
+    if (isinstance(field, (STORED, COLUMN))):
+        return _passthrough
+    return str
+
+
+
+class DocumentExtractor():
+    '''
+    Build Whoosh documents from data, for one Need class.
+    Built once, when the Need class is made. Pulls only the schema
+    fields, from objects (such as Model instances), dicts, or tuples
+    (such as rows from values_list()). Tuples must be in the order
+    of 'fieldnames'. Values are coerced to suit the field types (see
+    field_converter()).
+    Ignores keys not in schema. Dicts with no data for a schema key,
+    or None values, deliver no data for that key.
+
+    @param schema_fields dict of fieldname -> Whoosh field, in order
+    @param attnames attributes to read from objects, in order of
+    'fieldnames'. Default is the fieldnames.
+    @param digests add a digest of the values to each document, as DIGEST_FIELD
+    '''
+    def __init__(self, schema_fields, attnames=None, digests=False):
+        self.fieldnames = tuple(schema_fields)
+        self.digests = digests
+        self.attnames = tuple(attnames) if attnames else self.fieldnames
+        self.converters = {f : field_converter(schema_fields[f]) for f in self.fieldnames}
+        self._converters = tuple(self.converters[f] for f in self.fieldnames)
+        getter = attrgetter(*self.attnames)
+        if (len(self.attnames) == 1):
+            self._getter = lambda o: (getter(o),)
+        else:
+            self._getter = getter
+
+    def from_object(self, o):
+        return self.from_tuple(self._getter(o))
+
+    def _digested(self, doc):
+        if (self.digests):
+            doc[DIGEST_FIELD] = document_digest(doc)
+        return doc
+
+    def from_tuple(self, row):
+        return self._digested({f : convert(v) for f, convert, v in zip(self.fieldnames, self._converters, row) if v is not None})
+
+    def from_dict(self, data):
+        b = {}
+        for f, a, convert in zip(self.fieldnames, self.attnames, self._converters):
+            v = data.get(f, data.get(a))
+            if (v is not None):
+                b[f] = convert(v)
+        return self._digested(b)
+
+    def __call__(self, data):
+        if (isinstance(data, dict)):
+            return self.from_dict(data)
+        if (isinstance(data, (tuple, list))):
+            return self.from_tuple(data)
+        return self.from_object(data)
@@ -0,0 +1,102 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .managers import MergedPage
+
+
+# Pointer to the module object instance, for module-wide storage.
+this = sys.modules[__name__]
+
+# Not the managers' search pool. Federated searches wait on shard
+# searches, which would deadlock a shared, full pool.
+this.federation_pool = None
+this.federation_lock = threading.Lock()
+
+def _reset_after_fork():
+    # the pool's threads do not survive a fork
+    this.federation_pool = None
+    this.federation_lock = threading.Lock()
+
+if (hasattr(os, 'register_at_fork')):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+
+def federation_executor():
+    if (this.federation_pool is None):
+        with this.federation_lock:
+            if (this.federation_pool is None):
+                this.federation_pool = ThreadPoolExecutor(thread_name_prefix='need-federation')
+    return this.federation_pool
+
+
+
+class FederatedHit(dict):
+    '''
+    Stored fields of a hit from a federated search.
+    
+    @param need the Need class the hit came from
+    @param score score, normalised so the best hit from each Need is 1.0
+    '''
+    def __init__(self, fields, need, score):
+        super().__init__(fields)
+        self.need = need
+        self.score = score
+
+    def __repr__(self):
+        return 'FederatedHit({0}, need={1}, score={2})'.format(
+            super().__repr__(),
+            self.need.__name__,
+            self.score
+        )
+        
+        
+
+def federated_search(sources, query, limit=10):
+    '''
+    Search several Need classes at once.
+    The Needs are searched concurrently, through their 'actions' 
+    managers. Scores from different indexes are not comparable, so
+    each is divided by the best score from its Need, then all hits 
+    are merged.
+    
+    @param sources [(Need class, search field)...]
+    @param limit most hits to deliver, from each Need and in all.
+    @return (list of FederatedHit, in rank order, count of all hits)
+    '''
+    futures = [
+        federation_executor().submit(need.actions._top_hits, fieldnames, query, limit)
+        for need, fieldnames in sources
+    ]
+    b = []
+    total = 0
+    for (need, fieldnames), future in zip(sources, futures):
+        hits, count = future.result()
+        total += count
+        if (hits):
+            best = hits[0][0] or 1.0
+            b.extend(FederatedHit(fields, need, score / best) for score, fields in hits)
+    b.sort(key=lambda hit: -hit.score)
+    return b[:limit], total
+    
+def federated_read(sources, query, callback, limit=10):
+    '''
+    Read the top hits from several Need classes.
+    The callback is given a list of FederatedHit.
+    
+    @param sources [(Need class, search field)...]
+    '''
+    callback(federated_search(sources, query, limit)[0])
+
+def federated_read_page(sources, query, callback, page=1, pagelen=25):
+    '''
+    Read one page of hits from several Need classes.
+    The callback is given a MergedPage of FederatedHit.
+    
+    @param sources [(Need class, search field)...]
+    '''
+    page = max(page, 1)
+    hits, total = federated_search(sources, query, page * pagelen)
+    callback(MergedPage(hits, total, page, pagelen))
@@ -16,7 +16,7 @@ class LongField(NUMERIC):
     def __init__(self, stored=False, unique=False,
                  field_boost=1.0, shift_step=4, signed=True,
                  sortable=False, default=None):
-        super().__init__(long, 64, stored, unique,
+        super().__init__(int, 64, stored, unique,
                  field_boost, 0, shift_step, signed,
                  sortable, default)
 
@@ -29,7 +29,7 @@ class DecimalField(NUMERIC):
                  sortable=False, default=None):
         # first two parameters are irrelevant, only decimal_places
         #  works
-        super().__init__(long, 64, stored, unique,
+        super().__init__(int, 64, stored, unique,
                  field_boost, decimal_places, shift_step, signed,
                  sortable, default)  
                  
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.module_loading import autodiscover_modules
+
+from ...outbox import drain
+
+
+class Command(BaseCommand):
+    help = 'Apply Model changes recorded in the outbox to Need indexes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Changes written in one commit.')
+        parser.add_argument('--watch', action='store_true', help='Keep running, draining at intervals.')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between drains, with --watch.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database holding the outbox.')
+
+    def handle(self, *args, **options):
+        autodiscover_modules('need')
+        while (True):
+            count = drain(options['batch_size'], options['database'])
+            if (count and options['verbosity'] > 1):
+                self.stdout.write('Applied {0} changes'.format(count))
+            if (not options['watch']):
+                break
+            time.sleep(options['interval'])
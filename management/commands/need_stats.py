@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import autodiscover_modules
+
+from ...models import need_classes
+from ...segments import MergePolicy
+
+
+class Command(BaseCommand):
+    help = "Show segments, document counts, deletes and size of Need indexes. Can merge segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('need_index', nargs='*', help='Indexes to report. Default is all.')
+        parser.add_argument('--json', action='store_true', help='Print stats as JSON.')
+        parser.add_argument('--compact', action='store_true', help='Merge segments, if the policy says they need it.')
+        parser.add_argument('--max-segments', type=int, default=8, help='For --compact, most segments before a merge.')
+        parser.add_argument('--max-deleted-ratio', type=float, default=0.2, help='For --compact, most deleted documents in a segment before it is rewritten.')
+
+    def handle(self, *args, **options):
+        autodiscover_modules('need')
+        needs = need_classes
+        if (options['need_index']):
+            known = {need._meta.need_index : need for need in needs}
+            missing = [i for i in options['need_index'] if i not in known]
+            if (missing):
+                raise CommandError('No Need class for: {0}'.format(', '.join(missing)))
+            needs = [known[i] for i in options['need_index']]
+        if (options['compact']):
+            policy = MergePolicy(options['max_segments'], options['max_deleted_ratio'])
+            for need in needs:
+                if (need.actions.compact(policy)):
+                    self.stdout.write('{0}: merged'.format(need._meta.need_index))
+        stats = [need.actions.stats() for need in needs]
+        if (options['json']):
+            self.stdout.write(json.dumps(stats, indent=2))
+            return
+        for s in stats:
+            self.stdout.write('{index}: {segment_count} segments, {doc_count} documents, {deleted} deleted ({deleted_ratio:.1%}), {bytes} bytes, generation {generation}'.format(**s))
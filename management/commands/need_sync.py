@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import autodiscover_modules
+
+from ...models import need_classes
+
+
+class Command(BaseCommand):
+    help = "Write Model rows changed since the last sync to Need indexes. For ModelNeed classes with a 'modified_field' in Meta."
+
+    def add_arguments(self, parser):
+        parser.add_argument('need_index', nargs='*', help='Indexes to sync. Default is all with a modified_field.')
+        parser.add_argument('--full', action='store_true', help='Sync all rows, ignoring the watermark.')
+        parser.add_argument('--overlap', type=float, default=0, help='Seconds to step back from the watermark.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per commit.')
+        parser.add_argument('--no-deletes', action='store_false', dest='deletes', help='Do not look for deleted rows.')
+
+    def handle(self, *args, **options):
+        autodiscover_modules('need')
+        needs = [need for need in need_classes if need._meta.modified_field]
+        if (options['need_index']):
+            known = {need._meta.need_index : need for need in needs}
+            missing = [i for i in options['need_index'] if i not in known]
+            if (missing):
+                raise CommandError('No Need class with a modified_field for: {0}'.format(', '.join(missing)))
+            needs = [known[i] for i in options['need_index']]
+        for need in needs:
+            written, deleted = need.actions.sync(
+                full=options['full'],
+                overlap=options['overlap'],
+                batch_size=options['batch_size'],
+                deletes=options['deletes'],
+            )
+            self.stdout.write('{0}: {1} written, {2} deleted'.format(need._meta.need_index, written, deleted))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import autodiscover_modules
+
+from ...writer import WriterService
+
+
+class Command(BaseCommand):
+    help = 'Run the writer service, which commits writes sent by QueuedManagers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', help="Unix socket path. Default is settings.NEED_WRITER_ADDRESS, or 'writer.sock' in the WHOOSH folder.")
+        parser.add_argument('--max-pending', type=int, default=500, help='Operations held for an index before commit.')
+        parser.add_argument('--max-age', type=float, default=1.0, help='Seconds idle before held operations are committed.')
+
+    def handle(self, *args, **options):
+        autodiscover_modules('need')
+        service = WriterService(
+            address=options['address'],
+            max_pending=options['max_pending'],
+            max_age=options['max_age'],
+        )
+        self.stdout.write('Serving {0} indexes on {1}'.format(len(service.needs), service.address))
+        try:
+            service.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        if (service.errors):
+            self.stderr.write('{0} operations failed'.format(service.errors))
@@ -1,34 +1,800 @@
 import sys
+import os
+import re
+import shutil
+import copy
+import zlib
+import heapq
+import random
+import logging
+from math import ceil
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 #from whoosh import fields, index
-from whoosh.index import open_dir
-from whoosh.qparser import QueryParser, SimpleParser
+from whoosh.index import open_dir, create_in, exists_in, clean_files, LockError, TOC
+from whoosh.writing import CLEAR
+from whoosh.reading import SegmentReader
 from datetime import datetime, timedelta
 import time
-from django.db import models
-from django.forms.models import model_to_dict
+import atexit
+import threading
+from django.core.exceptions import ImproperlyConfigured
+from contextlib import contextmanager, ExitStack
+from whoosh.filedb.filestore import FileStorage, RamStorage
+from .cache import normalise_query
+from .parsing import ParserCache
+from .extractors import DIGEST_FIELD
+from .segments import index_stats, combine_stats, MergePolicy
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks, so locks hold only within a process
+    fcntl = None
+
+
+# Pointer to the module object instance, for module-wide storage.
+# https://stackoverflow.com/questions/1977362/how-to-create-module-wide-variables-in-python#1978076
+this = sys.modules[__name__]
+
+logger = logging.getLogger(__name__)
+
+this.blocking_lock = None
+# map of path to file_desciptor (whoosh index)
+this.ix_registry = {}
+this.registry_lock = threading.Lock()
+# process which filled the registry
+this.registry_pid = os.getpid()
+this.search_pool = None
+# map of id -> (writer, thread, index), for writers not yet closed
+this.open_writers = {}
+# map of (base, index) -> RamIndex, for indexes held in memory
+this.ram_indexes = {}
+
+def _reset_after_fork():
+    # A forked child inherits open files, held locks and a thread
+    # pool with no threads. Drop them all, to reopen on first use.
+    # In-memory indexes are kept, but not their locks.
+    for ram in this.ram_indexes.values():
+        ram.storage.locks = {}
+    this.ix_registry = {}
+    this.registry_lock = threading.Lock()
+    this.registry_pid = os.getpid()
+    this.search_pool = None
+    this.open_writers = {}
+
+if (hasattr(os, 'register_at_fork')):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+
+class SearcherPool():
+    '''
+    Open searchers on one index, reused across reads.
+    A searcher is held by one reader at a time. When taken from 
+    the pool, it is refreshed, which only reopens if the index 
+    generation has changed.
+    
+    @param max_idle searchers kept open when returned. Surplus are closed.
+    '''
+    def __init__(self, ix, max_idle=8):
+        self.ix = ix
+        self.max_idle = max_idle
+        self.closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        searcher = None
+        with self._lock:
+            if (self._idle):
+                searcher = self._idle.pop()
+        if (searcher is None):
+            return self.ix.searcher()
+        return searcher.refresh()
+
+    def release(self, searcher):
+        with self._lock:
+            if (not self.closed and (len(self._idle) < self.max_idle)):
+                self._idle.append(searcher)
+                return
+        searcher.close()
+
+    @contextmanager
+    def searcher(self):
+        '''
+        Context for a pooled searcher.
+        '''
+        searcher = self.acquire()
+        try:
+            yield searcher
+        finally:
+            self.release(searcher)
+
+    def close(self):
+        '''
+        Close idle searchers. Searchers in use are closed when returned.
+        '''
+        with self._lock:
+            self.closed = True
+            idle = self._idle
+            self._idle = []
+        for searcher in idle:
+            searcher.close()
+
+
+
+def _chunks(it, size):
+    it = iter(it)
+    while (True):
+        chunk = list(islice(it, size))
+        if (not chunk):
+            return
+        yield chunk
+
+
+
+def _pointer_path(base, index):
+    return os.path.join(base, index + '.current')
+    
+def index_location(base, index):
+    '''
+    Folder holding an index.
+    An index starts in the base folder. Once rebuilt, it lives in 
+    a sibling folder, named in a pointer file.
+    '''
+    try:
+        with open(_pointer_path(base, index)) as f:
+            return os.path.join(base, f.read().strip())
+    except FileNotFoundError:
+        return base
+
+def open_index(base, index):
+    ram = this.ram_indexes.get((base, index))
+    if (ram is not None):
+        return ram.storage.open_index(index)
+    return open_dir(index_location(base, index), index)
+
+def index_is_current(base, index, ix):
+    '''
+    True if an open index is the one writes go to now, not one 
+    swapped out by a rebuild.
+    '''
+    ram = this.ram_indexes.get((base, index))
+    if (ram is not None):
+        return ix.storage is ram.storage
+    return ix.storage.folder == index_location(base, index)
+
+def ensure_index(base, index, schema):
+    '''
+    Create an index, if it does not exist.
+    '''
+    if not exists_in(index_location(base, index), index):
+        create_in(base, schema, index)
+
+def swap_index(base, index, build_name):
+    '''
+    Point an index at a build folder.
+    The pointer is replaced atomically, so readers see the old 
+    index or the new, never neither.
+    '''
+    pointer = _pointer_path(base, index)
+    tmp = '{0}.{1}'.format(pointer, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(build_name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, pointer)
+
+def _watermark_path(base, index):
+    return os.path.join(base, index + '.watermark')
+
+def read_watermark(base, index):
+    '''
+    Modified time of the newest row synced to an index, or None.
+    '''
+    try:
+        with open(_watermark_path(base, index)) as f:
+            return datetime.fromisoformat(f.read().strip())
+    except FileNotFoundError:
+        return None
+
+def write_watermark(base, index, value):
+    path = _watermark_path(base, index)
+    tmp = '{0}.{1}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(value.isoformat())
+    os.replace(tmp, path)
+
+def clear_watermark(base, index):
+    '''
+    Forget the watermark, so the next sync writes all rows.
+    '''
+    try:
+        os.unlink(_watermark_path(base, index))
+    except FileNotFoundError:
+        pass
+
+def index_builds(base, index):
+    '''
+    Names of build folders for an index, oldest first.
+    '''
+    pattern = re.compile('^{0}[.][0-9]+$'.format(re.escape(index)))
+    return sorted(n for n in os.listdir(base) if pattern.match(n) and os.path.isdir(os.path.join(base, n)))
+
+def collect_index_builds(base, index, keep=1):
+    '''
+    Delete old generations of an index.
+    The current build is never deleted. An index in the base folder 
+    counts as older than any build.
+    
+    @param keep old generations to keep, newest first.
+    '''
+    location = index_location(base, index)
+    olds = [n for n in index_builds(base, index) if n != os.path.basename(location)]
+    olds.reverse()
+    if (location != base and exists_in(base, index)):
+        olds.append(None)
+    for name in olds[keep:]:
+        if (name is None):
+            clean_files(FileStorage(base), index, -1, [])
+        else:
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+
+
+def _live_keys(reader, fieldname):
+    # pks of documents not deleted
+    terms = reader.field_terms(fieldname)
+    if (not reader.has_deletions()):
+        return set(terms)
+    # terms of deleted documents stay until segments merge
+    return {t for t in terms if reader.postings(fieldname, t).is_active()}
+
+def _build_name(index):
+    return '{0}.{1}'.format(index, datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+def copy_index(source, dest, index):
+    '''
+    Copy the latest generation of an index between storages.
+    
+    @return the generation copied
+    '''
+    toc = TOC.read(source, index)
+    names = [TOC._filename(index, toc.generation)]
+    for seg in toc.segments:
+        names.extend(seg.list_files(source))
+    for name in names:
+        f = source.open_file(name)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        f = dest.create_file(name)
+        f.write(data)
+        f.close()
+    return toc.generation
+
+
+
+class RamIndex():
+    '''
+    An index held in memory, in a Whoosh RamStorage.
+    Loaded from the index on disk, if there is one, else created
+    empty. Snapshots are written as a new build of the index on 
+    disk, and swapped in, as rebuilds are. The index belongs to the
+    process; writes in one process are not seen in others.
+    
+    @param interval seconds between snapshots, and a snapshot at exit. Default is only on demand.
+    @param timeout seconds these snapshots wait for a writer to finish
+    '''
+    def __init__(self, base, index, schema, interval=None, timeout=10.0):
+        self.base = base
+        self.index = index
+        self.schema = schema
+        self.interval = interval
+        self.timeout = timeout
+        self.saved = None
+        self.restore()
+        if (interval):
+            self._schedule()
+            atexit.register(self._try_snapshot)
+
+    def restore(self):
+        '''
+        Load the index from disk, replacing the index in memory.
+        '''
+        storage = RamStorage()
+        location = index_location(self.base, self.index)
+        with metrics.timer('snapshot.restore', self.index):
+            if (exists_in(location, self.index)):
+                self.saved = copy_index(FileStorage(location), storage, self.index)
+            else:
+                storage.create_index(self.schema, self.index)
+                self.saved = None
+        self.storage = storage
+
+    def snapshot(self, keep=1, timeout=-1):
+        '''
+        Write the index to disk, if changed since loaded or last 
+        written. Writers wait until the copy is made.
+        
+        @param keep old generations on disk to keep. Older are deleted.
+        @param timeout seconds to wait for a writer to finish. Negative waits for ever.
+        @return True if written
+        '''
+        lock = self.storage.lock(self.index + '_WRITELOCK')
+        if (not lock.acquire(timeout=timeout)):
+            raise LockError("Index '{0}' stayed locked for {1} seconds".format(self.index, timeout))
+        try:
+            if (TOC.read(self.storage, self.index).generation == self.saved):
+                return False
+            name = _build_name(self.index)
+            path = os.path.join(self.base, name)
+            os.mkdir(path)
+            with metrics.timer('snapshot.write', self.index):
+                generation = copy_index(self.storage, FileStorage(path), self.index)
+        finally:
+            lock.release()
+        swap_index(self.base, self.index, name)
+        collect_index_builds(self.base, self.index, keep)
+        self.saved = generation
+        return True
+
+    def _schedule(self):
+        timer = threading.Timer(self.interval, self._tick)
+        timer.daemon = True
+        timer.start()
+
+    def _try_snapshot(self):
+        try:
+            self.snapshot(timeout=self.timeout)
+        except Exception:
+            metrics.count('snapshot.failures', 1, self.index)
+            logger.exception('Snapshot of index %s failed', self.index)
+
+    def _tick(self):
+        self._try_snapshot()
+        self._schedule()
+
+def ram_index(base, index, schema, interval=None, timeout=10.0):
+    '''
+    The in-memory index, loaded on first call.
+    '''
+    ram = this.ram_indexes.get((base, index))
+    if (ram is None):
+        ram = RamIndex(base, index, schema, interval, timeout)
+        this.ram_indexes[(base, index)] = ram
+    return ram
+
+
+
+class IndexLock():
+    '''
+    Lock on writes to one index, across threads and processes.
+    Threads in a process queue on a thread lock. Processes queue on
+    a file lock, a file beside the index. Time waited is recorded as 
+    'lock.wait'. Where file locks are not available, locks only 
+    within a process.
+    '''
+    def __init__(self, base, index):
+        self.path = os.path.join(base, index + '.lock')
+        self.index = index
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def _flock(self, fd, deadline):
+        if (deadline is None):
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return True
+        pause = 0.005
+        while (True):
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                left = deadline - time.monotonic()
+                if (left <= 0):
+                    return False
+                time.sleep(min(pause, left))
+                pause = min(pause * 2, 0.1)
+
+    def acquire(self, timeout=-1):
+        '''
+        @param timeout seconds to wait. Negative waits for ever.
+        @return True if acquired, False if the timeout passed
+        '''
+        deadline = None if (timeout < 0) else time.monotonic() + timeout
+        with metrics.timer('lock.wait', self.index):
+            if (not self._lock.acquire(timeout=timeout)):
+                return False
+            if (fcntl is not None):
+                fd = None
+                try:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    locked = self._flock(fd, deadline)
+                except BaseException:
+                    locked = False
+                    raise
+                finally:
+                    if (not locked):
+                        if (fd is not None):
+                            os.close(fd)
+                        self._lock.release()
+                if (not locked):
+                    return False
+                self._fd = fd
+        return True
+
+    def release(self):
+        fd = self._fd
+        self._fd = None
+        if (fd is not None):
+            # closing drops the file lock
+            os.close(fd)
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+
+class RegistryInfo():
+    '''
+    Shared state for one index.
+    Holds an open index, a lock, and a searcher pool. The pointer 
+    file for the index is checked, at most every 'check_interval' 
+    seconds, so swaps by rebuilds in any process are picked up.
+    '''
+    check_interval = 1.0
+    
+    def __init__(self, base, index, lock):
+        self.base = base
+        self.index = index
+        self.lock = lock
+        self._open()
+
+    def _pointer_stamp(self):
+        try:
+            st = os.stat(_pointer_path(self.base, self.index))
+            return (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+            
+    def _open(self):
+        self.stamp = self._pointer_stamp()
+        self.checked = time.time()
+        self.location = index_location(self.base, self.index)
+        with metrics.timer('index.open', self.index):
+            self.directory = open_index(self.base, self.index)
+        self.searchers = SearcherPool(self.directory)
+        
+    def refresh(self, force=False):
+        '''
+        Reopen, if the index has been swapped.
+        '''
+        now = time.time()
+        if (not force and (now - self.checked < self.check_interval)):
+            return
+        self.checked = now
+        if (force or self._pointer_stamp() != self.stamp):
+            old = self.searchers
+            self._open()
+            old.close()
+        
+def recover_stale_writers(base, index):
+    '''
+    Cancel writers on an index left open by threads which have ended.
+    Such writers hold the index lock until collected. Whoosh file 
+    locks end with the process, so writers in other processes are 
+    never stale. 
+    
+    @return count of writers cancelled
+    '''
+    with this.registry_lock:
+        stale = [k for k, (w, thread, key) in this.open_writers.items() if key == (base, index) and not thread.is_alive()]
+        writers = [this.open_writers.pop(k)[0] for k in stale]
+    for writer in writers:
+        try:
+            writer.cancel()
+        except Exception:
+            pass
+    return len(writers)
+
+def assert_index_registry(base, index):
+    if (this.registry_pid != os.getpid()):
+        # forked, without fork hooks
+        _reset_after_fork()
+    path = "{0}_{1}".format(base, index)
+    info = this.ix_registry.get(path)
+    if (info is None):
+        with this.registry_lock:
+            if (path not in this.ix_registry):
+                this.ix_registry[path] = RegistryInfo(base, index, IndexLock(base, index))
+            info = this.ix_registry[path]
+    else:
+        info.refresh()
+    return info
+
+
 
 
 #! auto-init with this data
 class BaseManager:    
-    def __init__(self):
+    # seconds a write waits on a locked index, before LockError
+    write_timeout = 10.0
+    # first and longest pause between tries on a locked index, in seconds
+    write_backoff = 0.01
+    write_backoff_max = 0.5
+
+    def __init__(self, cache=None):
+        self.cache = cache
         self._need_base = None
         self._need_index = None
         self._whoosh_schema = None
         self._schema_fields = None
+        self._extract = None
+        self._parsing = None
         self.model = None
         self.pk_fieldname = None
+        self.modified_field = None
+        self.digests = False
+        self.in_memory = False
+        self.snapshot_interval = None
         self.name = None
+        self._index_ready = False
         
     def contribute_to_class(self, opts):
         self._need_base = opts.need_base
         self._need_index = opts.need_index
         self._whoosh_schema = opts.schema
         self._schema_fields = opts.schema_fields
+        self._extract = opts.extractor
+        self._parsing = ParserCache(opts.schema)
         self.model = opts.model
-        self.pk_fieldname = opts.pk_field.name
+        self.pk_fieldname = opts.pk_field.name if opts.pk_field else None
+        self.modified_field = opts.modified_field
+        self.digests = opts.digests
+        self.in_memory = opts.in_memory
+        self.snapshot_interval = opts.snapshot_interval
         #self.name = 
 
+    def _timer(self, name):
+        return metrics.timer(name, self._need_index)
+
+    def _count(self, name, n=1):
+        metrics.count(name, n, self._need_index)
+        
+    def _ensure_index(self):
+        # indexes are created on first use, not when classes load
+        if (not self._index_ready):
+            with this.registry_lock:
+                if (self.in_memory):
+                    ram_index(self._need_base, self._need_index, self._whoosh_schema, self.snapshot_interval, self.write_timeout)
+                else:
+                    ensure_index(self._need_base, self._need_index, self._whoosh_schema)
+            self._index_ready = True
+
+    def _open(self):
+        self._ensure_index()
+        with self._timer('index.open'):
+            return open_index(self._need_base, self._need_index)
+
+    def _try_writer(self, ix, kwargs):
+        try:
+            return ix.writer(**kwargs)
+        except LockError:
+            self._count('lock.retries')
+            return None
+
+    def _writer(self, ix, **kwargs):
+        '''
+        A writer on the index.
+        If the index is locked, tries again, after pauses which 
+        double from 'write_backoff' to 'write_backoff_max' seconds, 
+        with jitter. Writers left by ended threads are cancelled. 
+        After 'write_timeout' seconds, raises LockError.
+        '''
+        with self._timer('writer.create'):
+            writer = self._try_writer(ix, kwargs)
+            if (writer is None):
+                with self._timer('lock.wait'):
+                    writer = self._wait_writer(ix, kwargs)
+        with this.registry_lock:
+            this.open_writers[id(writer)] = (writer, threading.current_thread(), (self._need_base, self._need_index))
+        return writer
+
+    def _wait_writer(self, ix, kwargs):
+        deadline = time.monotonic() + self.write_timeout
+        pause = self.write_backoff
+        if (recover_stale_writers(self._need_base, self._need_index)):
+            self._count('lock.recovered')
+            writer = self._try_writer(ix, kwargs)
+            if (writer is not None):
+                return writer
+        while (True):
+            left = deadline - time.monotonic()
+            if (left <= 0):
+                self._count('lock.failures')
+                raise LockError("Index '{0}' stayed locked for {1} seconds".format(self._need_index, self.write_timeout))
+            time.sleep(min(pause * random.uniform(0.5, 1.5), left))
+            pause = min(pause * 2, self.write_backoff_max)
+            writer = self._try_writer(ix, kwargs)
+            if (writer is not None):
+                return writer
+
+    def _closed(self, writer):
+        with this.registry_lock:
+            this.open_writers.pop(id(writer), None)
+
+    def _cancel(self, writer):
+        try:
+            writer.cancel()
+        except Exception:
+            # already closed, by a failed commit
+            pass
+        self._closed(writer)
+
+    def _commit(self, writer, **kwargs):
+        try:
+            with self._timer('commit'):
+                writer.commit(**kwargs)
+        except BaseException:
+            self._cancel(writer)
+            raise
+        self._closed(writer)
+
+    def _clear(self):
+        '''
+        Empty the index, in a commit.
+        The generation moves on, never back, so pooled searchers and
+        cached reads see the change. The schema is reset to the 
+        schema of the class.
+        '''
+        with self._writing(commit={'mergetype' : CLEAR}) as writer:
+            # the new TOC is written with the writer's schema
+            writer.schema = self._whoosh_schema
+        clear_watermark(self._need_base, self._need_index)
+
+    def _optimize(self):
+        '''
+        Merge all segments, in a commit.
+        '''
+        with self._writing(commit={'optimize' : True}):
+            pass
+
+    @contextmanager
+    def _writing(self, ix=None, commit=None, **kwargs):
+        '''
+        Context for a writer on the index. Committed at the end, or
+        cancelled if an error is raised, so the lock is released.
+        
+        @param ix index to write. Default is to open the index.
+        @param commit dict of arguments for the commit
+        '''
+        opened = (ix is None)
+        if (opened):
+            ix = self._open()
+        try:
+            writer = self._writer(ix, **kwargs)
+            while (opened and not index_is_current(self._need_base, self._need_index, ix)):
+                # a rebuild swapped the index while this waited
+                self._cancel(writer)
+                ix.close()
+                ix = self._open()
+                writer = self._writer(ix, **kwargs)
+            try:
+                yield writer
+            except BaseException:
+                self._cancel(writer)
+                raise
+            self._commit(writer, **(commit or {}))
+        finally:
+            if (opened):
+                ix.close()
+
+    def _parse(self, fieldnames, query):
+        with self._timer('parse'):
+            return self._parsing.parse(fieldnames, query)
+
+    def _search_in(self, searcher, query, **kwargs):
+        with self._timer('search'):
+            results = searcher.search(query, **kwargs)
+        self._count('hits.returned', results.scored_length())
+        return results
+        
+    def _registry(self):
+        self._ensure_index()
+        return assert_index_registry(self._need_base, self._need_index)
+
+    def open(self):
+        '''
+        Create the index if needed, and open it for shared use.
+        Indexes are opened on first use. Call this to pay the cost 
+        ahead, for example, when a process starts.
+        '''
+        self._registry()
+
+    def index_managers(self):
+        '''
+        Managers which each own one index. For most, this manager.
+        '''
+        return [self]
+
+    def flush_writes(self):
+        '''
+        Send on writes held or queued by the managers of each index.
+        Managers which write at once have nothing to send.
+        '''
+        for m in self.index_managers():
+            if (hasattr(m, 'flush')):
+                m.flush()
+
+    @property
+    def ix(self):
+        '''
+        The shared, open index.
+        '''
+        return self._registry().directory
+
+    def snapshot(self, keep=1):
+        '''
+        Write an in-memory index to disk, if changed.
+        Does nothing for indexes on disk.
+        
+        @param keep old generations on disk to keep. Older are deleted.
+        @return True if written
+        '''
+        if (not self.in_memory):
+            return False
+        self._ensure_index()
+        written = this.ram_indexes[(self._need_base, self._need_index)].snapshot(keep, self.write_timeout)
+        if (written):
+            self._registry().refresh(force=True)
+        return written
+
+    def _changed(self, docs):
+        '''
+        Documents which differ from those in the index.
+        With digests off, all documents.
+        
+        @param docs list of dicts, from _document()
+        '''
+        if (not self.digests or not docs):
+            return docs
+        pk_fieldname = self.pk_fieldname
+        with self._registry().searchers.searcher() as searcher:
+            reader = searcher.reader()
+            if (not reader.has_column(DIGEST_FIELD)):
+                # empty, or written before digests were on
+                return docs
+            digests = reader.column_reader(DIGEST_FIELD)
+            b = []
+            for data in docs:
+                docnum = searcher.document_number(**{pk_fieldname : data[pk_fieldname]})
+                if (docnum is None or digests[docnum] != data[DIGEST_FIELD]):
+                    b.append(data)
+        self._count('docs.unchanged', len(docs) - len(b))
+        return b
+
+    def _document(self, data):
+        '''
+        Normalise input to a dict of schema values, coerced to the field types.
+        
+        @param data object, dict, or tuple of values.
+        '''
+        return self._extract(data)
+
 
 
 #! change schema?
@@ -41,29 +807,19 @@ class Manager(BaseManager):
     '''
     A basic Whoosh manager.
     Every operation is self contained, and tidies after the action.
-    Note that if multiple threads access the writing, any writing 
-    operation can throw an error.
+    If another writer holds the index, writes wait, up to 
+    'write_timeout' seconds, then throw LockError.
     '''
-    def __init__(self):
-        super().__init__()
+    def __init__(self, cache=None):
+        super().__init__(cache)
 
     def bulk_add(self, it):
-        start = time.time()
-        ix = open_dir(self._need_base, self._need_index)
-        end = time.time()
-        print('opendir', 'took', str(end - start), 'time')
-        start = time.time()
-        writer = ix.writer()
-        end = time.time()
-        print('writer', 'took', str(end - start), 'time')
-        for e in it:
-            # expected inputs to dict with string values 
-            if (issubclass(e.__class__, models.Model)):
-                e = model_to_dict(e)
-            data = {f : str(e[f]) for f in self._schema_fields}
-            writer.add_document(e)
-        writer.commit()      
-        ix.close()
+        count = 0
+        with self._writing() as writer:
+            for e in it:
+                writer.add_document(**self._document(e))
+                count += 1
+        self._count('docs.written', count)
 
     def add(self, data):
         '''
@@ -72,25 +828,10 @@ class Manager(BaseManager):
         
         @param data object or dict of values. 
         '''
-        # expected inputs to dict with string values 
-        if (issubclass(data.__class__, models.Model)):
-            data = model_to_dict(data)
-        data = {f : str(data[f]) for f in self._schema_fields}
-        
-        start = time.time()
-        ix = open_dir(self._need_base, self._need_index)
-        end = time.time()
-        print('opendir', ' took', str(end - start), 'time')
-        start = time.time()
-        writer = ix.writer()
-        end = time.time()
-        print('writer', ' took', str(end - start), 'time')
-        writer.add_document(**data)
-        start = time.time()
-        writer.commit()
-        end = time.time()
-        print('commit', ' took', str(end - start), 'time')
-        ix.close()
+        data = self._document(data)
+        with self._writing() as writer:
+            writer.add_document(**data)
+        self._count('docs.written')
 
     def delete(self, key):
         '''
@@ -103,11 +844,9 @@ class Manager(BaseManager):
         # assert/except?
         # expected inputs to dict with string values 
         key = str(key)
-        ix = open_dir(self._need_base, self._need_index)
-        writer = ix.writer()
-        writer.delete_by_term(self.pk_fieldname, key, searcher=None)
-        writer.commit() 
-        ix.close() 
+        with self._writing() as writer:
+            writer.delete_by_term(self.pk_fieldname, key, searcher=None)
+        self._count('docs.deleted')
         
     def delete_when(self, fieldname, text):
         '''
@@ -117,11 +856,8 @@ class Manager(BaseManager):
         @param fieldname key to match against
         @param text match value. 
         '''
-        ix = open_dir(self._need_base, self._need_index)
-        writer = ix.writer()
-        writer.delete_by_term(fieldname, text, searcher=None)
-        writer.commit() 
-        ix.close()
+        with self._writing() as writer:
+            writer.delete_by_term(fieldname, text, searcher=None)
 
     def merge(self, data):
         '''
@@ -134,214 +870,1159 @@ class Manager(BaseManager):
         '''
         # "It is safe to use ``update_document`` in place of ``add_document``; if
         # there is no existing document to replace, it simply does an add."
-        # expected inputs to dict with string values 
-        if (issubclass(data.__class__, models.Model)):
-            data = model_to_dict(data)
-        data = {f : str(data[f]) for f in self._schema_fields}
-        ix = open_dir(self._need_base, self._need_index)
-        writer = ix.writer()
-        writer.update_document(**data)
-        writer.commit() 
-        ix.close()
+        data = self._document(data)
+        if (not self._changed([data])):
+            return
+        with self._writing() as writer:
+            writer.update_document(**data)
+        self._count('docs.written')
+
+    def _write_changes(self, docs, keys, terms=()):
+        '''
+        Merge documents, delete by pk, and delete by term, in one commit.
+        
+        @param docs list of dicts, from _document()
+        @param keys list of pks to delete, as strings
+        @param terms list of (fieldname, text) to delete
+        '''
+        docs = self._changed(docs)
+        if (not docs and not keys and not terms):
+            return
+        with self._writing() as writer:
+            for data in docs:
+                writer.update_document(**data)
+            for key in keys:
+                writer.delete_by_term(self.pk_fieldname, key, searcher=None)
+            for fieldname, text in terms:
+                writer.delete_by_term(fieldname, text, searcher=None)
+        self._count('docs.written', len(docs))
+        self._count('docs.deleted', len(keys))
+
+    def bulk_merge(self, it, batch_size=1000):
+        '''
+        Merge many documents.
+        Written through one writer, committed every 'batch_size' 
+        documents.
+        
+        @param it iterable of objects, dicts, or tuples of values
+        @return count of documents given
+        '''
+        count = 0
+        for chunk in _chunks((self._document(data) for data in it), batch_size):
+            self._write_changes(chunk, [])
+            count += len(chunk)
+        return count
 
+    def bulk_delete(self, keys, batch_size=1000):
+        '''
+        Delete many documents, by pk.
+        Committed every 'batch_size' keys.
+        
+        @param keys iterable of pks
+        @return count of keys given
+        '''
+        count = 0
+        for chunk in _chunks((str(key) for key in keys), batch_size):
+            self._write_changes([], chunk)
+            count += len(chunk)
+        return count
+
+    def bulk_delete_when(self, fieldname, values, batch_size=1000):
+        '''
+        Delete documents matching any of many values.
+        Committed every 'batch_size' values.
+        
+        @param fieldname key to match against
+        @param values iterable of match values
+        @return count of values given
+        '''
+        count = 0
+        for chunk in _chunks(((fieldname, text) for text in values), batch_size):
+            self._write_changes([], [], chunk)
+            count += len(chunk)
+        return count
+
+
+    def _indexed_keys(self):
+        with self._registry().searchers.searcher() as searcher:
+            return _live_keys(searcher.reader(), self.pk_fieldname)
+
+    def sync(self, full=False, overlap=0, chunk_size=2000, batch_size=1000, deletes=True, progress=None):
+        '''
+        Write model rows changed since the last sync.
+        Rows are found by the field named in Meta.modified_field, 
+        newer than a watermark kept beside the index. Deletions are 
+        found by comparing pks in the index with pks in the table. 
+        Writes are committed in batches. The watermark is moved on
+        when all is written, and held or queued writes are flushed. If
+        the flush fails, the watermark stays where it was.
+        
+        @param full sync all rows, ignoring the watermark
+        @param overlap seconds to step back from the watermark, for rows saved in long transactions
+        @param chunk_size rows fetched from the database at a time
+        @param batch_size rows written per commit
+        @param deletes delete documents for rows which are gone
+        @param progress callback(count), given the rows written, after each commit
+        @return (rows written, documents deleted)
+        '''
+        if (not self.modified_field):
+            raise ImproperlyConfigured("sync() needs a 'modified_field' in Meta, on a ModelNeed.")
+        since = None if full else read_watermark(self._need_base, self._need_index)
+        modified_attname = self.model._meta.get_field(self.modified_field).attname
+        qs = self.model._default_manager.all()
+        if (since is not None):
+            qs = qs.filter(**{self.modified_field + '__gte' : since - timedelta(seconds=overlap)})
+        rows = qs.values_list(*(self._extract.attnames + (modified_attname,))).iterator(chunk_size=chunk_size)
+        newest = since
+        written = 0
+        docs = []
+        for row in rows:
+            docs.append(self._extract.from_tuple(row[:-1]))
+            if (row[-1] is not None and (newest is None or row[-1] > newest)):
+                newest = row[-1]
+            if (len(docs) >= batch_size):
+                self._write_changes(docs, [])
+                written += len(docs)
+                docs = []
+                if (progress):
+                    progress(written)
+        if (docs):
+            self._write_changes(docs, [])
+            written += len(docs)
+            if (progress):
+                progress(written)
+        deleted = 0
+        if (deletes):
+            pks = self.model._default_manager.values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+            gone = sorted(self._indexed_keys().difference(str(pk) for pk in pks))
+            for i in range(0, len(gone), batch_size):
+                self._write_changes([], gone[i:i + batch_size])
+            deleted = len(gone)
+        # a failed flush raises, so the watermark is not moved past 
+        # writes which are not in the index
+        self.flush_writes()
+        if (newest is not None):
+            write_watermark(self._need_base, self._need_index, newest)
+        return (written, deleted)
 
+    def _generation(self):
+        # a rebuild starts a new folder at generation 1, so the folder
+        # is part of the version
+        info = self._registry()
+        return (os.path.basename(info.location), info.directory.latest_generation())
+        
+    def _cached(self, key, compute):
+        # value of 'compute', through the cache, for this generation
+        generation = self._generation()
+        value = self.cache.get(key, generation)
+        if (value is None):
+            value = compute()
+            self.cache.set(key, generation, value)
+        return value
+
+    def _cached_top_hits(self, fieldnames, query, limit):
+        '''
+        Top hits as dicts of stored fields, and the count of all hits,
+        through the cache.
+        '''
+        if (isinstance(fieldnames, list)):
+            fieldnames = tuple(fieldnames)
+        
+        def compute():
+            hits, total = self._top_hits(fieldnames, query, limit)
+            return ([self.cache.project(fields) for score, fields in hits], total)
+            
+        return self._cached((self._need_index, fieldnames, normalise_query(query), limit), compute)
+        
+    def _cached_read(self, fieldnames, query, callback):
+        callback(self._cached_top_hits(fieldnames, query, 10)[0])
+
+    def _cached_read_page(self, fieldnames, query, callback, page, pagelen):
+        # only the hits on the page are loaded and cached, keyed by 
+        # page and pagelen
+        page = max(page, 1)
+        if (isinstance(fieldnames, list)):
+            fieldnames = tuple(fieldnames)
+        
+        def compute():
+            hits, total = self._top_hits(fieldnames, query, page * pagelen, start=(page - 1) * pagelen)
+            last = max(int(ceil(total / pagelen)), 1)
+            if (page > last):
+                # past the end, so the last page
+                hits, total = self._top_hits(fieldnames, query, last * pagelen, start=(last - 1) * pagelen)
+            return ([self.cache.project(fields) for score, fields in hits], total)
+            
+        key = (self._need_index, fieldnames, normalise_query(query), ('page', page, pagelen))
+        hits, total = self._cached(key, compute)
+        callback(MergedPage(hits, total, page, pagelen, paged=True))
+        
     def read(self, fieldnames, query, callback):
-        start = time.time()
-        ix = open_dir(self._need_base, self._need_index)
-        end = time.time()
-        print('opendir', ' took', str(end - start), 'time')
-        r = None
-        with ix.searcher() as searcher:
-            start = time.time()
+        '''
+        Read the top hits.
+        The callback is given Whoosh Results. With a cache, it is 
+        given a list of dicts of stored fields.
+        '''
+        if (self.cache is not None):
+            return self._cached_read(fieldnames, query, callback)
+        with self._registry().searchers.searcher() as searcher:
             #query = QueryParser(field, self._whoosh_schema).parse(query)
-            query = SimpleParser(fieldnames, self._whoosh_schema).parse(query)
-            end = time.time()
-            print('query', ' took', str(end - start), 'time')
-            callback(searcher.search(query))
-        #ix.close()
+            query = self._parse(fieldnames, query)
+            callback(self._search_in(searcher, query))
+
+    def read_page(self, fieldnames, query, callback, page=1, pagelen=25):
+        '''
+        Read one page of hits.
+        Only the hits on the page are gathered. The callback is given 
+        a Whoosh ResultsPage, with 'pagenum', 'pagecount' and 'total'
+        attributes. A page past the end delivers the last page.
+        With a cache, the callback is given a MergedPage of dicts of 
+        stored fields.
+        
+        @param page number of the page, from 1
+        @param pagelen number of hits on a page
+        '''
+        if (self.cache is not None):
+            return self._cached_read_page(fieldnames, query, callback, page, pagelen)
+        with self._registry().searchers.searcher() as searcher:
+            query = self._parse(fieldnames, query)
+            with self._timer('search'):
+                results = searcher.search_page(query, max(page, 1), pagelen=pagelen)
+            self._count('hits.returned', min(results.pagelen, results.total))
+            callback(results)
+
+    def _top_hits(self, fieldnames, query, limit, start=0):
+        '''
+        Top hits, as (score, stored fields) pairs, and the count of 
+        all hits. Loads stored fields for the top hits only.
+        
+        @param start position of the first hit to load. Hits before it are skipped.
+        '''
+        with self._registry().searchers.searcher() as searcher:
+            query = self._parse(fieldnames, query)
+            results = self._search_in(searcher, query, limit=limit)
+            with self._timer('stored.load'):
+                return [(hit.score, hit.fields()) for hit in results[start:]], len(results)
+
+    @contextmanager
+    def stream(self, fieldnames, query, fields=None, limit=None, scored=True):
+        '''
+        Context for reading hits lazily.
+        The context delivers an iterator of dicts of stored fields. The 
+        searcher is held only while the context is open. Stop 
+        iterating at any time. Unscored streams deliver in index 
+        order, and walk any number of hits in constant memory.
+        ::
+        
+            with FireworkNeed.actions.stream('name', 'rocket', fields=['id']) as hits:
+                for hit in hits:
+                    ...
+        
+        @param fields stored fields to deliver. Default is all.
+        @param limit most hits to deliver. Default is all.
+        @param scored if False, skip scoring and deliver in index order
+        '''
+        with self._registry().searchers.searcher() as searcher:
+            query = self._parse(fieldnames, query)
+            live = [True]
+            
+            def hits():
+                if (scored):
+                    docnums = (hit.docnum for hit in self._search_in(searcher, query, limit=limit))
+                else:
+                    docnums = searcher.docs_for_query(query)
+                for i, docnum in enumerate(docnums):
+                    if (not live[0] or (limit is not None and i >= limit)):
+                        return
+                    with self._timer('stored.load'):
+                        data = searcher.stored_fields(docnum)
+                    if (fields is not None):
+                        data = {f : data[f] for f in fields if f in data}
+                    yield data
+                    
+            try:
+                yield hits()
+            finally:
+                live[0] = False
 
     def size(self):
-        ix = open_dir(self._need_base, self._need_index)
+        ix = self._open()
         r = ix.doc_count()
         ix.close()
         return r
 
+    def stats(self):
+        '''
+        Health of the index. 
+        A dict of segments, document counts, deleted ratio, generation,
+        and bytes on disk. See segments.index_stats().
+        '''
+        ix = self._open()
+        try:
+            return index_stats(ix)
+        finally:
+            ix.close()
+
+    def compact(self, policy=None):
+        '''
+        Merge segments, if a policy says they need it.
+        Does not wait; if the index is being written, nothing is 
+        done, and the merge is left for another time.
+        
+        @param policy a MergePolicy. Default is MergePolicy().
+        @return True if segments were merged.
+        '''
+        policy = policy or MergePolicy()
+        ix = self._open()
+        try:
+            if (not policy.needs_merge(index_stats(ix))):
+                return False
+            writer = self._try_writer(ix, {})
+            if (writer is None):
+                return False
+            with self._timer('merge'):
+                self._commit(writer, mergetype=policy.mergetype())
+            return True
+        finally:
+            ix.close()
+
         
 class ManagerManager(Manager):
     def clear(self):
         '''
         Empty the index.
         '''
-        self.ix.storage.clean()    
+        self._clear()
 
     def optimize(self):
-        self.ix.optimize()
+        self._optimize()
     
-    def load(self):
-        ix = open_dir(self._need_base, self._need_index)
-        writer = ix.writer()
-        for o in self.model.objects.all():
-            data = dict([(fn, str(getattr(o, fn))) for fn in self._schema_fields])
-            print(str(data))
-            writer.add_document(**data)
-        writer.commit()
-        ix.close()
+    def _load(self, ix, chunk_size=2000, batch_size=None, procs=1, multisegment=False, limitmb=128, progress=None):
+        kwargs = {'limitmb' : limitmb}
+        if (procs > 1):
+            kwargs.update(procs=procs, multisegment=multisegment)
+        rows = self.model.objects.values_list(*self._extract.attnames).iterator(chunk_size=chunk_size)
+        count = 0
+        for batch in (_chunks(rows, batch_size) if batch_size else [rows]):
+            written = 0
+            with self._writing(ix, **kwargs) as writer:
+                for row in batch:
+                    writer.add_document(**self._extract.from_tuple(row))
+                    written += 1
+            count += written
+            self._count('docs.written', written)
+            if (progress):
+                progress(count)
+        return count
         
+    def load(self, **kwargs):
+        '''
+        Load all model data to the index.
+        Rows are streamed from the database, reading only the schema 
+        columns, so memory is bounded by chunk and batch sizes.
         
-import threading
+        @param chunk_size rows fetched from the database at a time
+        @param batch_size rows written per commit. Default is all, in one commit.
+        @param procs writer processes. Above 1, uses Whoosh's multiprocess writer.
+        @param multisegment with procs, each process writes a segment, skipping the final merge. Faster, but searches slow.
+        @param limitmb memory for each writer, in megabytes
+        @param progress callback(count), given the rows written, after each commit
+        @return count of rows written
+        '''
+        return self._load(None, **kwargs)
+        
+    def rebuild(self, keep=1, **kwargs):
+        '''
+        Load all model data to a fresh index, then swap to it.
+        The index is built in a sibling folder, while reads and 
+        writes go to the old index. Then writes wait, while rows 
+        written to the old index during the build, by any process, 
+        are written again to the new index, as they are now. Then 
+        the index is switched, atomically. Readers and writers in 
+        all processes pick up the new index. Finding the rows holds
+        the pks of the old index in memory.
+        Takes the parameters of load().
+        
+        @param keep old generations to keep. Older are deleted.
+        @return count of rows written
+        '''
+        name = _build_name(self._need_index)
+        path = os.path.join(self._need_base, name)
+        os.mkdir(path)
+        # segments first, so a commit between is seen as a change
+        live = self._open()
+        segment_ids = {seg.segment_id() for seg in live._segments()}
+        with live.reader() as reader:
+            keys = _live_keys(reader, self.pk_fieldname)
+        ix = create_in(path, self._whoosh_schema, self._need_index)
+        count = self._load(ix, **kwargs)
+        # the old index is locked until swapped, so no write is missed
+        live = self._open()
+        writer = self._writer(live)
+        try:
+            self._replay(ix, self._changed_since(writer, keys, segment_ids))
+            ix.close()
+            swap_index(self._need_base, self._need_index, name)
+            if (self.in_memory):
+                this.ram_indexes[(self._need_base, self._need_index)].restore()
+        finally:
+            self._cancel(writer)
+            live.close()
+        self._registry().refresh(force=True)
+        collect_index_builds(self._need_base, self._need_index, keep)
+        return count
 
-# Pointer to the module object instance, for module-wide storage.
-# https://stackoverflow.com/questions/1977362/how-to-create-module-wide-variables-in-python#1978076
-this = sys.modules[__name__]
+    def _changed_since(self, writer, keys, segment_ids):
+        '''
+        Pks written to an index since it held 'keys', in the segments
+        'segment_ids'. Deleted pks are gone from the index; written 
+        pks are in new segments, as are all pks of merged segments.
+        
+        @param writer a writer on the index, so it does not change
+        '''
+        with writer.reader() as reader:
+            changed = keys - _live_keys(reader, self.pk_fieldname)
+        for seg in writer.segments:
+            if (seg.segment_id() not in segment_ids):
+                with SegmentReader(writer.storage, writer.schema, seg) as reader:
+                    changed.update(str(reader.stored_fields(docnum)[self.pk_fieldname]) for docnum in reader.all_doc_ids())
+        return changed
 
-this.blocking_lock = None
-# map of path to file_desciptor (whoosh index)
-this.ix_registry = {}
+    def _replay(self, ix, keys, batch_size=1000):
+        '''
+        Write pks to an index, from the rows as they are now. Rows 
+        which no longer exist are deleted. All in one commit.
+        '''
+        if (not keys):
+            return
+        written = 0
+        with self._writing(ix) as writer:
+            for chunk in _chunks(sorted(keys), batch_size):
+                rows = self.model._default_manager.filter(pk__in=chunk).values_list(*self._extract.attnames)
+                found = set()
+                for row in rows:
+                    data = self._extract.from_tuple(row)
+                    writer.update_document(**data)
+                    found.add(str(data[self.pk_fieldname]))
+                for key in chunk:
+                    if (key not in found):
+                        writer.delete_by_term(self.pk_fieldname, key, searcher=None)
+                written += len(found)
+        self._count('docs.written', written)
+        
+        
+        
+class BufferedManager(Manager):
+    '''
+    A Whoosh manager which gathers writes in memory.
+    Writes are held until a threshold is reached, then committed 
+    together, through one writer. Repeated writes to the same pk 
+    collapse to the last one. Pending writes are not visible to 
+    read() until flushed. Any pending writes are flushed at 
+    process exit.
+    
+    @param max_pending flush when this many writes are held
+    @param max_age flush when the oldest held write is this many seconds old
+    '''
+    def __init__(self, max_pending=500, max_age=5.0, cache=None):
+        super().__init__(cache)
+        self.max_pending = max_pending
+        self.max_age = max_age
+        # batches of ([(fieldname, text)], {key : (op, data)}), 
+        # committed in order. Keys are pks, or a counter where a 
+        # document has no pk to collapse on.
+        self._batches = [([], {})]
+        self._pending_since = None
+        self._serial = 0
+        self._flush_timer = None
+        # held briefly, to change held writes
+        self._buffer_lock = threading.RLock()
+        # held through commits, so flushes run one at a time
+        self._flush_lock = threading.RLock()
 
-class RegistryInfo():
-    def __init__(self, directory, lock):
-        self.directory = directory
-        self.lock = lock
+    def contribute_to_class(self, opts):
+        super().contribute_to_class(opts)
+        atexit.register(self.flush)
+        if (hasattr(os, 'register_at_fork')):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # held writes belong to the parent, which will flush them
+        self._batches = [([], {})]
+        self._pending_since = None
+        self._flush_timer = None
+        self._buffer_lock = threading.RLock()
+        self._flush_lock = threading.RLock()
+
+    def _key(self, data):
+        if (self.pk_fieldname and (self.pk_fieldname in data)):
+            return str(data[self.pk_fieldname])
+        with self._buffer_lock:
+            self._serial += 1
+            return ('_unkeyed', self._serial)
+
+    def _hold(self, key, op, data):
+        with self._buffer_lock:
+            docs = self._batches[-1][1]
+            held = docs.pop(key, None)
+            # an add replacing a held merge or delete, or a write in
+            # an earlier batch, must still remove that document
+            if (op == 'add' and ((held and held[0] != 'add') or any(key in d for t, d in self._batches[:-1]))):
+                op = 'merge'
+            docs[key] = (op, data)
+        self._held()
+
+    def _hold_terms(self, terms):
+        with self._buffer_lock:
+            held_terms, docs = self._batches[-1]
+            if (docs):
+                # a term delete reaches only committed documents, so 
+                # documents held before it go in an earlier commit
+                self._batches.append((list(terms), {}))
+            else:
+                held_terms.extend(terms)
+        self._held()
+
+    def _held(self):
+        with self._buffer_lock:
+            if (self._pending_since is None):
+                self._pending_since = time.time()
+                if (self.max_age):
+                    self._flush_timer = threading.Timer(self.max_age, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+            due = ((self.max_pending and (self.pending() >= self.max_pending))
+                or (self.max_age and (time.time() - self._pending_since >= self.max_age)))
+        # flushed outside the buffer lock, so writes are held meanwhile
+        if (due):
+            self.flush()
+            
+    def pending(self):
+        '''
+        Count of writes held, awaiting flush.
+        '''
+        return sum(len(terms) + len(docs) for terms, docs in self._batches)
         
-def assert_index_registry(base, index):
-    path = "{0}_{1}".format(base, index)
-    if (path not in this.ix_registry):
-            this.ix_registry[path] = RegistryInfo(open_dir(base, index), threading.Lock())
-    return this.ix_registry[path]
+    def bulk_add(self, it):
+        for data in it:
+            self.add(data)
+
+    def add(self, data):
+        '''
+        Hold a document for writing.
+        Ignores keys not in schema. No data for unprovided schema keys.
+        
+        @param data object or dict of values. 
+        '''
+        data = self._document(data)
+        self._hold(self._key(data), 'add', data)
+
+    def merge(self, data):
+        '''
+        Hold a document for merging.
+        Ignores keys not in schema. No data for unprovided schema keys.
+        Will create if entry does not exist.
+        
+        @param data object or dict of values.
+        '''
+        data = self._document(data)
+        self._hold(self._key(data), 'merge', data)
+
+    def delete(self, key):
+        '''
+        Hold a document for deletion.
+        
+        @param key to match against pk field.
+        '''
+        key = str(key)
+        self._hold(key, 'delete', None)
+
+    def delete_when(self, fieldname, text):
+        '''
+        Hold documents for deletion.
+        Match on any key. If document writes are held, the delete is
+        committed after them, so sees them.
+        
+        @param fieldname key to match against
+        @param text match value. 
+        '''
+        self._hold_terms([(fieldname, text)])
+
+    def _write_changes(self, docs, keys, terms=()):
+        for data in docs:
+            self._hold(self._key(data), 'merge', data)
+        for key in keys:
+            self._hold(key, 'delete', None)
+        if (terms):
+            self._hold_terms(terms)
+
+    def _take(self):
+        # held writes, removed from the buffer
+        with self._buffer_lock:
+            if (self._flush_timer):
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._pending_since = None
+            batches = self._batches
+            self._batches = [([], {})]
+        return [b for b in batches if (b[0] or b[1])]
+
+    def _restore(self, batches):
+        # writes not committed go back before writes held meanwhile
+        with self._buffer_lock:
+            keys = {key for terms, docs in batches for key in docs}
+            newer = [b for b in self._batches if (b[0] or b[1])]
+            for terms, docs in newer:
+                for key, (op, data) in docs.items():
+                    if (op == 'add' and key in keys):
+                        docs[key] = ('merge', data)
+            if (batches and newer and not newer[0][0]):
+                # no term delete between, so one commit will do
+                last = batches[-1][1]
+                for key, item in newer.pop(0)[1].items():
+                    last.pop(key, None)
+                    last[key] = item
+            self._batches = batches + newer
+            if (not self._batches):
+                self._batches = [([], {})]
+
+    def _commit_batch(self, terms, docs):
+        merges = [data for op, data in docs.values() if op == 'merge']
+        changed = {id(data) for data in self._changed(merges)}
+        written = 0
+        deleted = 0
+        with self._writing() as writer:
+            for fieldname, text in terms:
+                writer.delete_by_term(fieldname, text, searcher=None)
+            for key, (op, data) in docs.items():
+                if (op == 'add'):
+                    writer.add_document(**data)
+                    written += 1
+                elif (op == 'merge'):
+                    if (id(data) in changed):
+                        writer.update_document(**data)
+                        written += 1
+                else:
+                    writer.delete_by_term(self.pk_fieldname, key, searcher=None)
+                    deleted += 1
+        self._count('docs.written', written)
+        self._count('docs.deleted', deleted)
+
+    def flush(self):
+        '''
+        Write all held operations.
+        Held writes go in one commit, except that a term delete after
+        held documents starts another. Writes held during a flush 
+        wait for the next. If a commit fails, the writes not 
+        committed are held again.
+        '''
+        with self._flush_lock:
+            batches = self._take()
+            for i, batch in enumerate(batches):
+                try:
+                    self._commit_batch(*batch)
+                except BaseException:
+                    self._restore(batches[i:])
+                    raise
+
+    def flush_each(self):
+        '''
+        Write held operations in a commit each, in order, so one 
+        which fails does not hold back the others. Operations which 
+        fail are dropped, except on LockError or OSError, which may 
+        pass; then they, and the rest, are held again, and the error 
+        raised.
+        
+        @return list of (operation, error) for operations dropped. An operation is (op, key, data), or ('delete_when', fieldname, text).
+        '''
+        with self._flush_lock:
+            ops = []
+            for terms, docs in self._take():
+                ops.extend((None, term) for term in terms)
+                ops.extend(docs.items())
+            failed = []
+            for i, (key, item) in enumerate(ops):
+                try:
+                    if (key is None):
+                        self._commit_batch([item], {})
+                    else:
+                        self._commit_batch([], {key : item})
+                except (LockError, OSError):
+                    batches = []
+                    for key, item in ops[i:]:
+                        if (key is None):
+                            batches.append(([item], {}))
+                        else:
+                            if (not batches):
+                                batches.append(([], {}))
+                            batches[-1][1][key] = item
+                    self._restore(batches)
+                    raise
+                except Exception as e:
+                    if (key is None):
+                        failed.append((('delete_when',) + item, e))
+                    else:
+                        failed.append(((item[0], key, item[1]), e))
+            return failed
+        
+        
+
+
     
     
     
-class BlockingManagerManager(Manager):
-    def contribute_to_class(self, opts):
-        super().contribute_to_class(opts)
-        #self.threadLock = threading.Lock()
-        #self.ix = open_dir(self._need_base, self._need_index)
-        info = assert_index_registry(self._need_base, self._need_index)
-        self.ix = info.directory
-        self.threadLock = info.lock
+class QueuedManager(Manager):
+    '''
+    A Whoosh manager which sends writes to a writer service.
+    Writes return once sent, without waiting on a commit. The 
+    service (see 'writer', and the 'need_writer' command) owns the 
+    writer for each index, so processes do not contend for locks.
+    Writes are visible to read() once the service commits. Reads 
+    are direct. Not for Need classes with shards.
+    
+    @param address of the service. Default is writer.writer_address()
+    '''
+    def __init__(self, address=None, cache=None):
+        super().__init__(cache)
+        self.address = address
+        self._local = threading.local()
+
+    def _connection(self):
+        from .writer import connect
+        
+        local = self._local
+        # a connection is not shared by threads, or a forked child
+        if (getattr(local, 'pid', None) != os.getpid()):
+            local.conn = connect(self.address)
+            local.pid = os.getpid()
+        return local.conn
+
+    def _send(self, op, *args):
+        message = (self._need_index, op, args)
+        try:
+            self._connection().send(message)
+        except (OSError, EOFError):
+            # the service restarted. Try once more, on a new connection
+            self._local.pid = None
+            self._connection().send(message)
+
+    def bulk_add(self, it):
+        self._send('bulk_add', [self._document(data) for data in it])
+
+    def add(self, data):
+        '''
+        Send a document to write.
+        
+        @param data object or dict of values. 
+        '''
+        self._send('add', self._document(data))
+
+    def merge(self, data):
+        '''
+        Send a document to merge.
+        
+        @param data object or dict of values.
+        '''
+        self._send('merge', self._document(data))
+
+    def delete(self, key):
+        '''
+        Send a document for deletion.
+        
+        @param key to match against pk field.
+        '''
+        self._send('delete', str(key))
+
+    def delete_when(self, fieldname, text):
+        '''
+        Send documents for deletion.
         
+        @param fieldname key to match against
+        @param text match value. 
+        '''
+        self._send('delete_when', fieldname, text)
+
+    def _write_changes(self, docs, keys, terms=()):
+        for data in docs:
+            self._send('merge', data)
+        for key in keys:
+            self._send('delete', key)
+        for fieldname, text in terms:
+            self._send('delete_when', fieldname, text)
+
+    def flush(self):
+        '''
+        Ask the service to commit writes held for this index.
+        '''
+        self._send('flush')
+
+
+
+class IndexLockMixin():
+    '''
+    For managers which take the lock on the index, shared by 
+    threads and processes.
+    '''
+    @property
+    def threadLock(self):
+        # shared by managers on the index, so found on first use
+        return self._registry().lock
+
+    def compact(self, policy=None):
+        # a merge is left for later, not waited for
+        lock = self.threadLock
+        if (not lock.acquire(0)):
+            return False
+        try:
+            return super().compact(policy)
+        finally:
+            lock.release()
+
+
+
+class BlockingManagerManager(IndexLockMixin, Manager):
     def clear(self):
         '''
         Empty the index.
         '''
-        self.threadLock.acquire()
-        #On fileStorage and RAMStorage, clean()
-        # Storage. Can only do on Filestorage.
-        #ix.storage.destroy()
-        self.ix.storage.clean()    
-        self.threadLock.release()
+        with self.threadLock:
+            self._clear()
 
     def optimize(self):
-        self.threadLock.acquire()
-        self.ix.optimize()
-        self.threadLock.release()
+        with self.threadLock:
+            self._optimize()
         
         
                 
-class BlockingManager(Manager):
+class BlockingManager(IndexLockMixin, Manager):
     '''
     A basic Whoosh manager.
     Every operation is self contained, and tidies after the action.
-    The operations are blocking.
+    The operations are blocking. Writers wait on a lock for the 
+    index, shared by threads and processes, held until commit.
+    Waits are bounded by 'write_timeout'.
+    '''
+    def __init__(self, cache=None):
+        super().__init__(cache)
+
+    @contextmanager
+    def _writing(self, ix=None, **kwargs):
+        lock = self.threadLock
+        if (not lock.acquire(self.write_timeout)):
+            self._count('lock.failures')
+            raise LockError("Index '{0}' stayed locked for {1} seconds".format(self._need_index, self.write_timeout))
+        try:
+            with super()._writing(ix, **kwargs) as writer:
+                yield writer
+        finally:
+            lock.release()
+
+    def size(self):
+        r = self.ix.doc_count()
+        return r
+    
+
+
+
+def search_executor():
+    '''
+    Thread pool for searches run in parallel.
     '''
-    def __init__(self):
-        super().__init__()
+    if (this.search_pool is None):
+        with this.registry_lock:
+            if (this.search_pool is None):
+                this.search_pool = ThreadPoolExecutor(thread_name_prefix='need-search')
+    return this.search_pool
+    
+def merge_hits(results, limit=None):
+    '''
+    Merge several sets of scored hits into one ranking.
+    
+    @param results iterables of hits, each in score order.
+    @param limit most hits to deliver. Default is all.
+    '''
+    return islice(heapq.merge(*results, key=lambda hit: -hit.score), limit)
         
+
+        
+class MergedPage():
+    '''
+    A page of hits merged from several searches.
+    Like a Whoosh ResultsPage, has 'pagenum', 'pagecount', 'total', 
+    'offset' and 'pagelen' attributes. A page past the end is the 
+    last page.
+    
+    @param hits merged hits, from the first, to at least the end of the page
+    @param total count of hits over all searches
+    @param paged if True, 'hits' are the hits of the page only
+    '''
+    def __init__(self, hits, total, pagenum, pagelen, paged=False):
+        self.total = total
+        self.pagecount = int(ceil(total / pagelen))
+        self.pagenum = min(self.pagecount, pagenum)
+        self.offset = max(self.pagenum - 1, 0) * pagelen
+        start = 0 if paged else self.offset
+        self.hits = hits[start:start + pagelen]
+        self.pagelen = len(self.hits)
+
+    def __len__(self):
+        return self.pagelen
+        
+    def __getitem__(self, n):
+        return self.hits[n]
+        
+    def __iter__(self):
+        return iter(self.hits)
+        
+
+                
+class ShardedManager(Manager):
+    '''
+    A Whoosh manager for Need classes with shards.
+    Documents are routed to a shard by a hash of the pk. Writes go 
+    to the owning shard, through a manager for each shard. Reads 
+    search all shards in parallel, then merge hits by score. Scores 
+    are calculated within each shard, so ranking is approximate 
+    where shards differ in term statistics.
+    
+    @param shard_class manager class used for each shard. Default is ManagerManager.
+    '''
+    def __init__(self, shard_class=None, cache=None):
+        super().__init__(cache)
+        self.shard_class = shard_class or ManagerManager
+        self.shards = []
+
     def contribute_to_class(self, opts):
         super().contribute_to_class(opts)
-        self.threadLock = threading.Lock()
-        self.ix = open_dir(self._need_base, self._need_index)
+        self.shards = []
+        for need_index in opts.indexes:
+            shard_opts = copy.copy(opts)
+            shard_opts.need_index = need_index
+            shard_opts.shards = 1
+            manager = self.shard_class()
+            manager.contribute_to_class(shard_opts)
+            self.shards.append(manager)
+            
+    def _generation(self):
+        return tuple(shard._generation() for shard in self.shards)
+
+    def open(self):
+        for shard in self.shards:
+            shard.open()
+
+    def index_managers(self):
+        return self.shards
+        
+    def shard_number(self, key):
+        '''
+        Number of the shard owning a pk.
+        '''
+        return zlib.crc32(str(key).encode('utf-8')) % len(self.shards)
+
+    def shard_for(self, key):
+        return self.shards[self.shard_number(key)]
+
+    def _write_routed(self, docs, batch_size=None, limitmb=128, progress=None):
+        count = 0
+        for batch in (_chunks(docs, batch_size) if batch_size else [docs]):
+            # all commit, or, on error, all cancel
+            with ExitStack() as stack:
+                ws = [stack.enter_context(shard._writing(limitmb=limitmb)) for shard in self.shards]
+                for data in batch:
+                    ws[self.shard_number(data[self.pk_fieldname])].add_document(**data)
+                    count += 1
+            if (progress):
+                progress(count)
+        self._count('docs.written', count)
+        return count
         
     def bulk_add(self, it):
-        def to_dict(data):
-            # expected inputs to dict with string values 
-            if (issubclass(e.__class__, models.Model)):
-                e = model_to_dict(e)
-            return {f : str(e[f]) for f in self._schema_fields}
-        it = [to_dict(data) for data in it]
-        self.threadLock.acquire()
-        writer = self.ix.writer()
-        self.threadLock.release()
-        for e in it:
-            writer.add_document(e)
-        writer.commit()      
+        self._write_routed(self._document(data) for data in it)
 
     def add(self, data):
         '''
-        Write a document.
-        Ignores keys not in schema. No data for unprovided schema keys.
+        Write a document, to the owning shard.
         
         @param data object or dict of values. 
         '''
-        # expected inputs to dict with string values 
-        if (issubclass(data.__class__, models.Model)):
-            data = model_to_dict(data)
-        data = {f : str(data[f]) for f in self._schema_fields}
-        start = time.time()
-        self.threadLock.acquire()
-        end = time.time()
-        print('aquire', ' took', str(end - start), 'time')
-        writer = self.ix.writer()
-        self.threadLock.release()
-        writer.add_document(**data)
-        writer.commit()
+        data = self._document(data)
+        self.shard_for(data[self.pk_fieldname]).add(data)
+
+    def merge(self, data):
+        '''
+        Merge a document, in the owning shard.
         
+        @param data object or dict of values.
+        '''
+        data = self._document(data)
+        self.shard_for(data[self.pk_fieldname]).merge(data)
+
     def delete(self, key):
         '''
-        Delete a document.
+        Delete a document, from the owning shard.
         
-        @param key to match against pk field. 
+        @param key to match against pk field.
         '''
-        key = str(key)
-        self.threadLock.acquire()
-        writer = self.ix.writer()
-        self.threadLock.release()
-        writer.delete_by_term(self.pk_fieldname, key, searcher=None)
-        writer.commit()
-
+        self.shard_for(key).delete(key)
+        
     def delete_when(self, fieldname, text):
         '''
-        Delete documents.
-        Match on any key.
+        Delete documents, from every shard.
         
         @param fieldname key to match against
         @param text match value. 
         '''
-        self.threadLock.acquire()
-        writer = self.ix.writer()
-        self.threadLock.release()
-        writer.delete_by_term(fieldname, text, searcher=None)
-        writer.commit()
+        for shard in self.shards:
+            shard.delete_when(fieldname, text)
+
+    def _write_changes(self, docs, keys, terms=()):
+        routed = [([], []) for shard in self.shards]
+        for data in docs:
+            routed[self.shard_number(data[self.pk_fieldname])][0].append(data)
+        for key in keys:
+            routed[self.shard_number(key)][1].append(key)
+        # terms may match in any shard
+        for shard, (shard_docs, shard_keys) in zip(self.shards, routed):
+            if (shard_docs or shard_keys or terms):
+                shard._write_changes(shard_docs, shard_keys, terms)
+
+    def _indexed_keys(self):
+        b = set()
+        for shard in self.shards:
+            b.update(shard._indexed_keys())
+        return b
+
+    @contextmanager
+    def _searchers(self):
+        pools = [shard._registry().searchers for shard in self.shards]
+        searchers = [pool.acquire() for pool in pools]
+        try:
+            yield searchers
+        finally:
+            for pool, searcher in zip(pools, searchers):
+                pool.release(searcher)
+
+    def _search(self, searchers, query, limit):
+        with self._timer('search'):
+            results = list(search_executor().map(lambda s: s.search(query, limit=limit), searchers))
+        self._count('hits.returned', sum(r.scored_length() for r in results))
+        return results
         
-    def merge(self, **data):
+    def read(self, fieldnames, query, callback):
         '''
-        Merge a document.
-        Ignores keys not in schema. No data for unprovided schema keys.
-        Checks for unique keys then matches against parameters.
-        Slower than add(). Will create if entry does not exist.
-        
-        @param data object or dict of values. 
+        The callback is given a list of the top hits, over all shards.
         '''
-        # expected inputs to dict with string values 
-        if (issubclass(data.__class__, models.Model)):
-            data = model_to_dict(data)
-        data = {f : str(data[f]) for f in self._schema_fields}
-        self.threadLock.acquire()
-        writer = self.ix.writer()
-        self.threadLock.release()
-        writer.update_document(**data)
-        writer.commit()
+        if (self.cache is not None):
+            return self._cached_read(fieldnames, query, callback)
+        with self._searchers() as searchers:
+            query = self._parse(fieldnames, query)
+            callback(list(merge_hits(self._search(searchers, query, 10), 10)))
 
-    def read(self, fieldnames, query, callback):
-        r = None
-        with self.ix.searcher() as searcher:
-            start = time.time()
-            query = SimpleParser(fieldnames, self._whoosh_schema).parse(query)
-            end = time.time()
-            print('query', ' took', str(end - start), 'time')
-            callback(searcher.search(query))
+    def read_page(self, fieldnames, query, callback, page=1, pagelen=25):
+        '''
+        Read one page of hits, over all shards.
+        The callback is given a MergedPage.
+        '''
+        if (self.cache is not None):
+            return self._cached_read_page(fieldnames, query, callback, page, pagelen)
+        page = max(page, 1)
+        with self._searchers() as searchers:
+            query = self._parse(fieldnames, query)
+            results = self._search(searchers, query, page * pagelen)
+            total = sum(len(r) for r in results)
+            callback(MergedPage(list(merge_hits(results, page * pagelen)), total, page, pagelen))
+
+    def _top_hits(self, fieldnames, query, limit, start=0):
+        with self._searchers() as searchers:
+            query = self._parse(fieldnames, query)
+            results = self._search(searchers, query, limit)
+            with self._timer('stored.load'):
+                hits = [(hit.score, hit.fields()) for hit in islice(merge_hits(results, limit), start, None)]
+            return hits, sum(len(r) for r in results)
+
+    @contextmanager
+    def stream(self, fieldnames, query, fields=None, limit=None, scored=True):
+        '''
+        Context for reading hits lazily, over all shards.
+        Unscored streams deliver each shard in turn.
+        '''
+        with self._searchers() as searchers:
+            query = self._parse(fieldnames, query)
+            live = [True]
+            
+            def stored():
+                if (scored):
+                    for hit in merge_hits(self._search(searchers, query, limit), limit):
+                        yield hit.searcher, hit.docnum
+                else:
+                    for searcher in searchers:
+                        for docnum in searcher.docs_for_query(query):
+                            yield searcher, docnum
+                        
+            def hits():
+                for i, (searcher, docnum) in enumerate(stored()):
+                    if (not live[0] or (limit is not None and i >= limit)):
+                        return
+                    with self._timer('stored.load'):
+                        data = searcher.stored_fields(docnum)
+                    if (fields is not None):
+                        data = {f : data[f] for f in fields if f in data}
+                    yield data
+
+            try:
+                yield hits()
+            finally:
+                live[0] = False
 
     def size(self):
-        r = self.ix.doc_count()
-        return r
-    
+        return sum(shard.size() for shard in self.shards)
+
+    def clear(self):
+        '''
+        Empty every shard.
+        '''
+        # through the shard manager's writes, so any lock is taken
+        for shard in self.shards:
+            shard._clear()
+        clear_watermark(self._need_base, self._need_index)
+
+    def optimize(self):
+        for shard in self.shards:
+            shard._optimize()
+
+    def snapshot(self, keep=1):
+        '''
+        Write in-memory shards to disk, if changed.
+        
+        @return True if any shard was written
+        '''
+        return any([shard.snapshot(keep) for shard in self.shards])
+
+    def stats(self):
+        '''
+        Health of the shards, totalled. 
+        Stats for each shard are under 'shards'.
+        '''
+        return combine_stats(self._need_index, [shard.stats() for shard in self.shards])
+
+    def compact(self, policy=None):
+        '''
+        Merge segments of each shard which needs it.
+        
+        @return True if segments of any shard were merged.
+        '''
+        policy = policy or MergePolicy()
+        return any([shard.compact(policy) for shard in self.shards])
+        
+    def load(self, chunk_size=2000, **kwargs):
+        '''
+        Load all model data to the shards.
+        Rows are streamed, and routed to a writer for each shard.
+        
+        @param chunk_size rows fetched from the database at a time
+        @param batch_size rows written per commit, over all shards. Default is all, in one commit.
+        @param limitmb memory for each writer, in megabytes
+        @param progress callback(count), given the rows written, after each commit
+        @return count of rows written
+        '''
+        rows = self.model.objects.values_list(*self._extract.attnames).iterator(chunk_size=chunk_size)
+        return self._write_routed((self._extract.from_tuple(row) for row in rows), **kwargs)
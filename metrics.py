@@ -0,0 +1,206 @@
+import sys
+import time
+import threading
+from bisect import bisect_left
+
+from django.dispatch import Signal
+
+
+# Pointer to the module object instance, for module-wide storage.
+this = sys.modules[__name__]
+
+# Sent by SignalInstrument. Arguments are 'name', 'index', and
+# 'seconds' or 'n'.
+timing_recorded = Signal()
+count_recorded = Signal()
+
+
+
+class _NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+
+
+class Timer():
+    __slots__ = ('instrument', 'name', 'index', 'start')
+
+    def __init__(self, instrument, name, index):
+        self.instrument = instrument
+        self.name = name
+        self.index = index
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrument.timing(self.name, time.perf_counter() - self.start, self.index)
+        return False
+
+
+
+class Instrument():
+    '''
+    Receives timings and counts from the managers.
+    This base does nothing, at little cost. Names used by the
+    managers are,
+
+    timers
+        index.open, lock.wait, writer.create, commit, parse, search, stored.load,
+        warm_up, merge, snapshot.restore, snapshot.write
+    counters
+        docs.written, docs.deleted, docs.unchanged, hits.returned,
+        lock.retries, lock.recovered, lock.failures, snapshot.failures
+    '''
+    def timer(self, name, index=None):
+        '''
+        Context, timing the enclosed code.
+        '''
+        return NULL_TIMER
+
+    def timing(self, name, seconds, index=None):
+        pass
+
+    def count(self, name, n=1, index=None):
+        pass
+
+
+
+class RecordingInstrument(Instrument):
+    '''
+    Base for instruments which record.
+    '''
+    def timer(self, name, index=None):
+        return Timer(self, name, index)
+
+
+
+class Histogram():
+    '''
+    Counts of timings, in fixed buckets.
+
+    @param bounds upper bounds of the buckets, in seconds. Timings
+    above the last fall in an overflow bucket.
+    '''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if (self.min is None or seconds < self.min):
+            self.min = seconds
+        if (self.max is None or seconds > self.max):
+            self.max = seconds
+
+    def quantile(self, q):
+        '''
+        Estimate of a quantile, as the bound of its bucket.
+        '''
+        if (not self.count):
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if (seen >= target):
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+
+class MemoryInstrument(RecordingInstrument):
+    '''
+    Records timings to histograms, and counts, in memory.
+    Keyed by (name, index).
+    '''
+    bounds = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def timing(self, name, seconds, index=None):
+        key = (name, index)
+        with self._lock:
+            h = self.histograms.get(key)
+            if (h is None):
+                h = self.histograms[key] = Histogram(self.bounds)
+            h.add(seconds)
+
+    def count(self, name, n=1, index=None):
+        key = (name, index)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def snapshot(self):
+        '''
+        Data recorded so far, as plain dicts.
+        '''
+        with self._lock:
+            return {
+                'timers': {'{0}:{1}'.format(*k) : h.as_dict() for k, h in self.histograms.items()},
+                'counters': {'{0}:{1}'.format(*k) : n for k, n in self.counters.items()},
+            }
+
+
+
+class SignalInstrument(RecordingInstrument):
+    '''
+    Sends timings and counts as Django signals, 'timing_recorded'
+    and 'count_recorded'.
+    '''
+    def timing(self, name, seconds, index=None):
+        timing_recorded.send(sender=self.__class__, name=name, seconds=seconds, index=index)
+
+    def count(self, name, n=1, index=None):
+        count_recorded.send(sender=self.__class__, name=name, n=n, index=index)
+
+
+
+this.instrument = Instrument()
+
+def set_instrument(instrument):
+    '''
+    Set the instrument used by all managers.
+    '''
+    this.instrument = instrument
+
+def timer(name, index=None):
+    return this.instrument.timer(name, index)
+
+def count(name, n=1, index=None):
+    this.instrument.count(name, n, index)
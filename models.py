@@ -1,4 +1,5 @@
 import os
+import sys
 #from django.db.models import signals
 from django.conf import settings
 from django.db import models
@@ -8,11 +9,11 @@ from django.core.exceptions import (
 )
 
 from whoosh import fields #, index
-from whoosh.index import create_in, exists_in
 from whoosh.fields import FieldType
 
-from .managers import BaseManager, Manager, BlockingManager
-from .fields import TextField, IdField
+from .managers import BaseManager, Manager, BlockingManager, ShardedManager, QueuedManager
+from .fields import TextField, IdField, DateTimeField
+from .extractors import DocumentExtractor, DIGEST_FIELD, digest_field
 #from .models import File
 
 # need the add/update triggers in there
@@ -23,6 +24,13 @@ from .fields import TextField, IdField
 # absolute URL option
 # autofield automatic inclusion if present?
       
+# Pointer to the module object instance, for module-wide storage.
+this = sys.modules[__name__]
+
+# Need classes, in order of creation
+this.need_classes = []
+
+
 #! make as a dict
 def default_need_field(klass):
     '''
@@ -89,6 +97,14 @@ class NeedOptions:
         if not self.need_index:
             self.need_index = "{0}_{1}".format(app_label, class_name)  
         self.need_base = getattr(options, 'need_base') 
+        self.shards = getattr(options, 'shards', 1)
+        self.warm_up = getattr(options, 'warm_up', False)
+        self.warm_queries = getattr(options, 'warm_queries', [])
+        self.outbox = getattr(options, 'outbox', False)
+        self.modified_field = getattr(options, 'modified_field', None)
+        self.digests = getattr(options, 'digests', False)
+        self.in_memory = getattr(options, 'in_memory', False)
+        self.snapshot_interval = getattr(options, 'snapshot_interval', None)
         self.module = module
         self.class_name = class_name
         self.requested_fields = getattr(options, 'fields')
@@ -102,6 +118,17 @@ class NeedOptions:
             self.pk_field = None
         self.schema_fields = []
         self.schema = None
+        self.extractor = None
+        self.managers = {}
+
+    @property
+    def indexes(self):
+        '''
+        Names of the Whoosh indexes, one for each shard.
+        '''
+        if (self.shards > 1):
+            return ["{0}_{1}".format(self.need_index, i) for i in range(self.shards)]
+        return [self.need_index]
 
     def __str__(self):
         return "NeedOptions(need_index:{0}, need_base:{1}, module:{2}, model:{3}, requested_fields:{4}, declared_fields:{5}, schema_fields:{6})".format(
@@ -145,7 +172,43 @@ class NeedMetaclass(DeclarativeFieldsMetaclass):
 
     def _validate_clean_opts(mcs, opts):
         '''stub for model validation'''
-        pass
+        if (opts.digests and opts.pk_field is None):
+            raise ImproperlyConfigured(
+                "Whoosh class {0}.{1} declares digests, but digests are matched on a pk field, and it has none.".format(
+                opts.module, 
+                opts.class_name
+                )
+            )
+
+    def _validate_managers(mcs, opts, managers):
+        if (opts.shards > 1):
+            if (opts.pk_field is None):
+                raise ImproperlyConfigured(
+                    "Whoosh class {0}.{1} declares shards, but shards are routed on a pk field, and it has none.".format(
+                    opts.module, 
+                    opts.class_name
+                    )
+                )
+            for k, manager in managers.items():
+                if (not isinstance(manager, ShardedManager)):
+                    raise ImproperlyConfigured(
+                        "Whoosh class {0}.{1} declares shards, but manager '{2}' is not a ShardedManager.".format(
+                        opts.module, 
+                        opts.class_name,
+                        k
+                        )
+                    )
+        if (opts.outbox):
+            # a drain deletes entries once written, but a 
+            # QueuedManager only sends, so they could be lost
+            actions = managers['actions']
+            if (isinstance(actions, QueuedManager) or (isinstance(actions, ShardedManager) and issubclass(actions.shard_class, QueuedManager))):
+                raise ImproperlyConfigured(
+                    "Whoosh class {0}.{1} declares an outbox, but writes through a QueuedManager, which does not wait on a commit.".format(
+                    opts.module, 
+                    opts.class_name
+                    )
+                )
         
     def _schema_fields(mcs, opts):
         b = {}
@@ -163,9 +226,17 @@ class NeedMetaclass(DeclarativeFieldsMetaclass):
                     )
         return b
         
-    def _first_run(mcs, need_index, whoosh_schema):
-        if not exists_in(settings.WHOOSH, need_index):
-            create_in(settings.WHOOSH, whoosh_schema, need_index)
+    def _extractor(mcs, opts):
+        return DocumentExtractor(opts.schema_fields, digests=opts.digests)
+        
+    def open_indexes(cls):
+        '''
+        Create, if needed, and open the indexes of this class.
+        Indexes are opened on first use. This is an optional 
+        warm-up, so the cost is paid ahead.
+        '''
+        for manager in cls._meta.managers.values():
+            manager.open()
 
 
     def __new__(mcs, name, bases, attrs):
@@ -218,11 +289,13 @@ class NeedMetaclass(DeclarativeFieldsMetaclass):
         
         # build scema info, populate meta
         schema_fields = new_class._meta.schema_fields = new_class._schema_fields(clean_opts)
-        whoosh_schema = new_class._meta.schema = fields.Schema(**schema_fields)
+        new_class._meta.schema = fields.Schema(**schema_fields)
+        if (clean_opts.digests):
+            new_class._meta.schema.add(DIGEST_FIELD, digest_field())
+        new_class._meta.extractor = new_class._extractor(clean_opts)
         #print('new_class._meta:' + str(new_class._meta))
 
-        # if needed, create index folders
-        new_class._first_run(new_class._meta.need_index, whoosh_schema) 
+        # index folders are created, and opened, on first use
         
         # set managers
         managers = {k:v for k,v in attrs.items() if isinstance(v, BaseManager)}
@@ -235,10 +308,13 @@ class NeedMetaclass(DeclarativeFieldsMetaclass):
                     )
                 ) 
         if (not 'actions' in managers):
-            new_class.actions = Manager()
+            new_class.actions = ShardedManager() if (clean_opts.shards > 1) else Manager()
             managers['actions'] = new_class.actions
+        new_class._validate_managers(clean_opts, managers)
+        clean_opts.managers = managers
         for manager in managers.values():
             manager.contribute_to_class(clean_opts)
+        this.need_classes.append(new_class)
             
 
         return new_class
@@ -271,11 +347,21 @@ class ModelNeedMetaclass(NeedMetaclass):
                     opts.model.__name__
                     )
                 )              
+        if (opts.modified_field and opts.modified_field not in model_fieldnames):
+            raise ImproperlyConfigured(
+                "ModelNeed class {0}.{1} declares a modified_field '{2}' not in Model {3}.".format(
+                opts.module, 
+                opts.class_name, 
+                opts.modified_field,
+                opts.model.__name__
+                )
+            )
 
     def _schema_fields(mcs, opts):        
-        # add the pk field if missing
-        fields_to_use = set(opts.requested_fields)
-        fields_to_use.add(opts.pk_field.name)
+        # add the pk field if missing (first, so order is stable)
+        fields_to_use = list(opts.requested_fields)
+        if (opts.pk_field.name not in fields_to_use):
+            fields_to_use.insert(0, opts.pk_field.name)
         b = {}
         for fieldname in fields_to_use:
             declared = opts.declared_fields.get(fieldname)
@@ -299,9 +385,18 @@ class ModelNeedMetaclass(NeedMetaclass):
             if (fieldname == opts.pk_field.name):
                 b[fieldname].stored = True
         return b
+
+    def _extractor(mcs, opts):
+        # read the raw column values, not related objects
+        attnames = [opts.model._meta.get_field(f).attname for f in opts.schema_fields]
+        return DocumentExtractor(opts.schema_fields, attnames, opts.digests)
         
     def __new__(mcs, name, bases, attrs):
         new_class = super().__new__(mcs, name, bases, attrs)
+        opts = getattr(new_class, '_meta', None)
+        if (opts and opts.outbox):
+            from .outbox import connect
+            connect(new_class)
         return new_class
         
         
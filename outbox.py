@@ -0,0 +1,101 @@
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+
+from .models import need_classes
+
+
+
+# Not in 'models', which loads with the package, before Django
+# can register Models. Loaded by NeedConfig.ready().
+class OutboxEntry(models.Model):
+    '''
+    A Model row changed, and awaiting indexing.
+    '''
+    id = models.BigAutoField(primary_key=True)
+    need_index = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'need'
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.need_index, self.key)
+
+
+
+def record_change(need, key, using=None):
+    '''
+    Record that the row for a pk has changed.
+    Written in the transaction of the change, so a rollback removes 
+    it, and a commit makes it durable.
+    '''
+    OutboxEntry.objects.using(using).create(need_index=need._meta.need_index, key=str(key))
+
+def connect(need):
+    '''
+    Record saves and deletes of the Model of a ModelNeed class.
+    Set by 'outbox = True' in Meta.
+    '''
+    def changed(sender, instance, using=None, **kwargs):
+        record_change(need, instance.pk, using)
+
+    uid = 'need.outbox.{0}'.format(need._meta.need_index)
+    post_save.connect(changed, sender=need._meta.model, weak=False, dispatch_uid=uid)
+    post_delete.connect(changed, sender=need._meta.model, weak=False, dispatch_uid=uid)
+
+
+
+def apply_keys(need, keys, using=None):
+    '''
+    Bring the index of a ModelNeed up to date, for some pks.
+    Rows which exist are merged, in their current state. Rows which
+    do not are deleted. All in one commit.
+    
+    @param keys pks, as strings
+    '''
+    opts = need._meta
+    extract = opts.extractor
+    pk_fieldname = opts.pk_field.name
+    rows = opts.model._default_manager.using(using).filter(pk__in=keys).values_list(*extract.attnames)
+    docs = [extract.from_tuple(row) for row in rows]
+    found = {str(data[pk_fieldname]) for data in docs}
+    need.actions._write_changes(docs, [key for key in keys if key not in found])
+    # held or queued writes are sent on before their entries go
+    need.actions.flush_writes()
+
+def drain_batch(batch_size=1000, using=None):
+    '''
+    Apply the oldest recorded changes.
+    Repeated changes to a row collapse to one write. Entries for Need
+    classes not loaded in this process are left in the outbox, for a
+    process which has them.
+    
+    @return count of entries applied
+    '''
+    needs = {need._meta.need_index : need for need in need_classes}
+    entries = list(OutboxEntry.objects.using(using).filter(need_index__in=list(needs)).order_by('id').values_list('id', 'need_index', 'key')[:batch_size])
+    if (not entries):
+        return 0
+    changed = {}
+    for _, need_index, key in entries:
+        changed.setdefault(need_index, set()).add(key)
+    for need_index, keys in changed.items():
+        apply_keys(needs[need_index], keys, using)
+    # by id, so entries committed meanwhile, with lower ids, are kept
+    OutboxEntry.objects.using(using).filter(id__in=[e[0] for e in entries]).delete()
+    return len(entries)
+
+def drain(batch_size=1000, using=None):
+    '''
+    Apply recorded changes, in batches, until none are left.
+    
+    @param batch_size entries read, and written in one commit, at a time
+    @return count of entries applied
+    '''
+    total = 0
+    while (True):
+        count = drain_batch(batch_size, using)
+        if (not count):
+            return total
+        total += count
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+from whoosh.qparser import SimpleParser
+
+
+
+class ParserCache():
+    '''
+    Parsers, and parsed queries, for one schema.
+    A parser is made once for each set of fieldnames. Parsed queries
+    are kept, so repeated query text is not parsed again. Parsed
+    queries are bounded by LRU eviction.
+
+    @param schema Whoosh schema
+    @param max_queries most parsed queries kept
+    '''
+    def __init__(self, schema, max_queries=512):
+        self.schema = schema
+        self.max_queries = max_queries
+        self._parsers = {}
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parser(self, fieldnames):
+        if (isinstance(fieldnames, list)):
+            fieldnames = tuple(fieldnames)
+        parser = self._parsers.get(fieldnames)
+        if (parser is None):
+            parser = self._parsers[fieldnames] = SimpleParser(fieldnames, self.schema)
+        return parser
+
+    def parse(self, fieldnames, text):
+        '''
+        Parsed query for text.
+        '''
+        if (isinstance(fieldnames, list)):
+            fieldnames = tuple(fieldnames)
+        key = (fieldnames, text)
+        with self._lock:
+            query = self._queries.get(key)
+            if (query is not None):
+                self._queries.move_to_end(key)
+                return query
+        query = self.parser(fieldnames).parse(text)
+        with self._lock:
+            self._queries[key] = query
+            while (len(self._queries) > self.max_queries):
+                self._queries.popitem(last=False)
+        return query
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
@@ -0,0 +1,175 @@
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from whoosh.reading import SegmentReader
+from whoosh.writing import OPTIMIZE
+
+
+
+def _ratio(part, whole):
+    return part / whole if whole else 0.0
+
+def index_stats(ix):
+    '''
+    Health of an open index.
+    Segment counts, document counts, deleted documents, generation,
+    and size of the index files, in bytes.
+    '''
+    storage = ix.storage
+    segments = []
+    for seg in ix._segments():
+        size = sum(storage.file_length(name) for name in seg.list_files(storage))
+        segments.append({
+            'id': seg.segment_id(),
+            'doc_count_all': seg.doc_count_all(),
+            'deleted': seg.deleted_count(),
+            'deleted_ratio': _ratio(seg.deleted_count(), seg.doc_count_all()),
+            'bytes': size,
+        })
+    generation = ix.latest_generation()
+    toc = '_{0}_{1}.toc'.format(ix.indexname, generation)
+    doc_count_all = sum(s['doc_count_all'] for s in segments)
+    deleted = sum(s['deleted'] for s in segments)
+    return {
+        'index': ix.indexname,
+        'generation': generation,
+        'segment_count': len(segments),
+        'doc_count': doc_count_all - deleted,
+        'doc_count_all': doc_count_all,
+        'deleted': deleted,
+        'deleted_ratio': _ratio(deleted, doc_count_all),
+        'bytes': sum(s['bytes'] for s in segments) + (storage.file_length(toc) if storage.file_exists(toc) else 0),
+        'segments': segments,
+    }
+
+def combine_stats(index, stats):
+    '''
+    Totals of the stats of several indexes, such as shards.
+    '''
+    doc_count_all = sum(s['doc_count_all'] for s in stats)
+    deleted = sum(s['deleted'] for s in stats)
+    return {
+        'index': index,
+        'generation': [s['generation'] for s in stats],
+        'segment_count': sum(s['segment_count'] for s in stats),
+        'doc_count': doc_count_all - deleted,
+        'doc_count_all': doc_count_all,
+        'deleted': deleted,
+        'deleted_ratio': _ratio(deleted, doc_count_all),
+        'bytes': sum(s['bytes'] for s in stats),
+        'shards': stats,
+    }
+
+
+
+class MergePolicy():
+    '''
+    When, and how, to merge the segments of an index.
+    Every commit can add a segment, and deletes stay in segments
+    until merged, so searches slow. When an index has more than
+    'max_segments', the smallest are merged into one, to bring the
+    count down. Segments with more than 'max_deleted_ratio' deleted
+    documents are rewritten without them. These merges touch only
+    some segments. A full optimize, merging all segments, runs only
+    in 'optimize_hours'.
+
+    @param max_segments most segments, before small segments are merged
+    @param max_deleted_ratio most deleted documents in a segment, as a fraction, before it is rewritten
+    @param optimize_hours hours of the day (0-23) when a full optimize may run instead. Default is never.
+    '''
+    def __init__(self, max_segments=8, max_deleted_ratio=0.2, optimize_hours=()):
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+        self.optimize_hours = optimize_hours
+
+    def needs_merge(self, stats):
+        return (stats['segment_count'] > self.max_segments) or any(
+            s['deleted_ratio'] > self.max_deleted_ratio for s in stats['segments']
+        )
+
+    def mergetype(self, now=None):
+        '''
+        The Whoosh merge function, for a commit now.
+        '''
+        if ((now or datetime.now()).hour in self.optimize_hours):
+            return OPTIMIZE
+        return self
+
+    def __call__(self, writer, segments):
+        # a Whoosh merge function. Readers given to the writer are
+        # merged into its new segment. Returns segments left as they are.
+        selected = [s for s in segments if _ratio(s.deleted_count(), s.doc_count_all()) > self.max_deleted_ratio]
+        surplus = len(segments) - self.max_segments
+        if (surplus > 0):
+            smallest = sorted((s for s in segments if s not in selected), key=lambda s: s.doc_count_all())
+            selected.extend(smallest[:surplus + 1])
+        for seg in selected:
+            reader = SegmentReader(writer.storage, writer.schema, seg)
+            writer.add_reader(reader)
+            reader.close()
+        return [s for s in segments if s not in selected]
+
+
+
+class MergeScheduler(threading.Thread):
+    '''
+    A thread which, every 'interval' seconds, compacts the indexes
+    of Need classes, as a MergePolicy says. Merges do not wait for
+    writers; a busy index is merged on a later round.
+    
+    @param needs Need classes. Default is all Need classes.
+    @param policy a MergePolicy. Default is MergePolicy().
+    @param interval seconds between rounds
+    '''
+    def __init__(self, needs=None, policy=None, interval=300):
+        super().__init__(name='need-merge', daemon=True)
+        self.needs = needs
+        self.policy = policy or MergePolicy()
+        self.interval = interval
+        self.errors = 0
+        self._stopped = threading.Event()
+
+    def run_once(self):
+        '''
+        Compact every index which needs it.
+        
+        @return count of indexes merged
+        '''
+        needs = self.needs
+        if (needs is None):
+            from .models import need_classes
+            needs = need_classes
+        merged = 0
+        for need in needs:
+            try:
+                merged += need.actions.compact(self.policy)
+            except Exception:
+                self.errors += 1
+        return merged
+
+    def run(self):
+        while (not self._stopped.wait(self.interval)):
+            self.run_once()
+
+    def stop(self):
+        self._stopped.set()
+
+
+
+def start_merge_scheduler():
+    '''
+    Start a MergeScheduler from settings.
+    NEED_MERGE_INTERVAL is seconds between rounds; if unset, no 
+    scheduler is started. NEED_MERGE_POLICY is a dict of MergePolicy 
+    arguments.
+    
+    @return the scheduler, or None
+    '''
+    interval = getattr(settings, 'NEED_MERGE_INTERVAL', None)
+    if (not interval):
+        return None
+    policy = MergePolicy(**getattr(settings, 'NEED_MERGE_POLICY', {}))
+    scheduler = MergeScheduler(policy=policy, interval=interval)
+    scheduler.start()
+    return scheduler
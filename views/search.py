@@ -4,9 +4,9 @@ from django.views.generic.base import TemplateView, View
 
 from django.core.exceptions import ImproperlyConfigured
 from ..forms import SearchForm
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 from ..renderers import HitRendererText
+from ..federated import federated_read_page
 
 
 class HitsMixin():         
@@ -17,6 +17,9 @@ class HitsMixin():
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self._check_need()
+        
+    def _check_need(self):
         if (self.need is None):
             raise ImproperlyConfigured("Model view search '{0}' must have a Need class defined.".format(
                 self.__class__.__name__
@@ -29,9 +32,14 @@ class HitsMixin():
     def indexdata_to_renderdata(self, result):
         ''' Hook for processing generic results before template'''
         return result
+
+    def read_page(self, query, callback, page):
+        ''' Hook for reading a page of hits'''
+        self.need.actions.read_page(self.search_fields, query, callback, page, self.page_count)
         
     def get_hits_context(self, kwargs, query, page):
         def build_results(results):
+            pagination.extend([results.pagenum, results.pagecount])
             for r in results:
                hit_data.append(self.indexdata_to_renderdata(r))
                
@@ -39,26 +47,25 @@ class HitsMixin():
         prv = None
         nxt = None
         if query:
-            hit_data = []
-            self.need.actions.read(self.search_fields, query, build_results)
-
-            pg = Paginator(hit_data, self.page_count)
             try:
-                xo = pg.page(page)
-            except PageNotAnInteger:
+                page = int(page)
+            except (TypeError, ValueError):
                 # If page is not an integer, deliver first page.
-                xo = pg.page(1)
-            except EmptyPage:
-                # If page is out of range (e.g. 9999), deliver last page of results.
-                xo = pg.page(pg.num_pages)
+                page = 1
+            hit_data = []
+            pagination = []
+            # If page is out of range (e.g. 9999), the read delivers 
+            # the last page of results.
+            self.read_page(query, build_results, page)
+            pagenum, pagecount = pagination
 
             #! these need to go to template
-            if (xo.has_previous()):
-                prv =  xo.previous_page_number()
-            if (xo.has_next()):
-                nxt =  xo.next_page_number()
+            if (pagenum > 1):
+                prv = pagenum - 1
+            if (pagenum < pagecount):
+                nxt = pagenum + 1
             
-            hits = self.renderer.as_html(xo)
+            hits = self.renderer.as_html(hit_data)
         kwargs['hits'] = hits
         kwargs['prev_page'] = prv
         kwargs['next_page'] = nxt
@@ -168,12 +175,13 @@ class SearchHitView(TemplateView, HitsMixin):
         query = self.request.GET.get('search', None)
         if query:
             self.get_hits_context(kwargs, query, page)
+        form = self.form(initial=query)
         media = form.media + self.renderer.media
         if 'media' in kwargs:
             kwargs['media'] = kwargs['media'] + media
         else:
             kwargs['media'] =  media
-        kwargs['form'] =  self.form(initial=query)
+        kwargs['form'] =  form
         return super().get_context_data(**kwargs)
         
         
@@ -243,3 +251,39 @@ class ListView(TemplateView, HitsMixin):
         else:
             kwargs['media'] = self.renderer.media
         return super().get_context_data(**kwargs)
+
+
+
+class FederatedHitsMixin(HitsMixin):
+    '''
+    Hits from several Need classes, in one ranking.
+    The Needs are searched concurrently. Each result given to
+    indexdata_to_renderdata() is a FederatedHit, a dict of stored 
+    fields with a 'need' attribute, the Need class it came from.
+    
+    @param needs [(Need class, search field)...]
+    '''
+    needs = []
+    
+    def _check_need(self):
+        if (not self.needs):
+            raise ImproperlyConfigured("Federated view search '{0}' must have a 'needs' attribute defined.".format(
+                self.__class__.__name__
+                ))
+
+    def read_page(self, query, callback, page):
+        federated_read_page(self.needs, query, callback, page, self.page_count)
+
+
+
+class FederatedSearchHitView(FederatedHitsMixin, SearchHitView):
+    '''
+    SearchHitView, over several Need classes.
+    '''
+
+
+
+class FederatedListView(FederatedHitsMixin, ListView):
+    '''
+    ListView, over several Need classes.
+    '''
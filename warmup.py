@@ -0,0 +1,103 @@
+import time
+import logging
+
+from django.conf import settings
+from whoosh.query import Every
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class Deadline():
+    '''
+    Time left from a budget.
+    
+    @param budget seconds. None is no limit.
+    '''
+    def __init__(self, budget=None):
+        self.end = None if (budget is None) else time.monotonic() + budget
+
+    def passed(self):
+        return (self.end is not None) and (time.monotonic() >= self.end)
+
+
+
+def _warm_manager(manager, sortable, queries, deadline):
+    manager.open()
+    with manager._registry().searchers.searcher() as searcher:
+        # sorting loads the column data, so sorted reads start warm
+        for fieldname in sortable:
+            if (deadline.passed()):
+                return False
+            searcher.search(Every(), sortedby=fieldname, limit=1)
+        for fieldnames, text in queries:
+            if (deadline.passed()):
+                return False
+            for hit in manager._search_in(searcher, manager._parse(fieldnames, text), limit=10):
+                hit.fields()
+    return True
+
+def warm_up(need, queries=None, deadline=None):
+    '''
+    Open the indexes of a Need class, and load them, before reads.
+    For each index, a searcher is opened and left in the pool, data 
+    for sortable fields is loaded, and warm queries are run. 
+    Stops if the deadline passes.
+    
+    @param need a Need class
+    @param queries list of (fieldnames, query text). Default is Meta.warm_queries.
+    @param deadline a Deadline. Default is no limit.
+    @return True if finished, False if stopped by the deadline
+    '''
+    opts = need._meta
+    queries = opts.warm_queries if (queries is None) else queries
+    deadline = deadline or Deadline()
+    sortable = [f for f, field in opts.schema_fields.items() if field.column_type]
+    with metrics.timer('warm_up', opts.need_index):
+        for manager in opts.managers.values():
+            for m in manager.index_managers():
+                if (deadline.passed() or not _warm_manager(m, sortable, queries, deadline)):
+                    return False
+    return True
+
+def warm_up_all(needs, budget=None):
+    '''
+    Warm up several Need classes, in one time budget.
+    
+    Warm-up is optional, so a Need class which fails is logged, 
+    and skipped.
+    
+    @param needs Need classes
+    @param budget seconds. None is no limit.
+    @return Need classes fully warmed
+    '''
+    deadline = Deadline(budget)
+    b = []
+    for need in needs:
+        try:
+            warmed = warm_up(need, deadline=deadline)
+        except Exception:
+            logger.exception('Warm-up failed for Need index %s', need._meta.need_index)
+            continue
+        if (not warmed):
+            break
+        b.append(need)
+    return b
+
+def warm_up_registered():
+    '''
+    Warm up Need classes, as set by settings.
+    NEED_WARM_UP True warms every Need class. Unset, only classes 
+    with Meta.warm_up. False warms none. NEED_WARM_UP_BUDGET is 
+    the time budget in seconds, default 5.
+    '''
+    from .models import need_classes
+    
+    setting = getattr(settings, 'NEED_WARM_UP', None)
+    if (setting is False):
+        return []
+    needs = [n for n in need_classes if setting or n._meta.warm_up]
+    return warm_up_all(needs, getattr(settings, 'NEED_WARM_UP_BUDGET', 5.0))
@@ -0,0 +1,229 @@
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+from functools import partial
+from multiprocessing.connection import Listener, Client
+
+from django.conf import settings
+
+from whoosh.index import LockError
+
+from .managers import BufferedManager, ShardedManager
+
+
+logger = logging.getLogger(__name__)
+
+
+def writer_address():
+    '''
+    Address of the writer service, a Unix socket.
+    Set by NEED_WRITER_ADDRESS, default 'writer.sock' in the WHOOSH folder.
+    '''
+    return getattr(settings, 'NEED_WRITER_ADDRESS', None) or os.path.join(settings.WHOOSH, 'writer.sock')
+
+def writer_authkey():
+    # messages are pickled, so only clients knowing the site secret are heard
+    return hashlib.sha256(('need.writer:' + settings.SECRET_KEY).encode('utf-8')).digest()
+
+def connect(address=None):
+    '''
+    Connection to the writer service.
+    '''
+    return Client(address or writer_address(), family='AF_UNIX', authkey=writer_authkey())
+
+
+
+class WriterService():
+    '''
+    A process owning the writers for Need indexes.
+    Clients (see QueuedManager) send write operations over a Unix
+    socket. Operations are queued, applied in order by one thread,
+    and committed in batches, so there is one writer for each index,
+    and no lock contention. A batch is committed when 'max_pending'
+    operations are held for an index, when no operation has arrived
+    for 'max_age' seconds, and every 'max_age' seconds. Held writes
+    are committed on close.
+    A failed commit is logged, and the index is tried again after a
+    pause, doubling from 'retry_backoff' to 'retry_backoff_max' 
+    seconds. After 'max_failures' failures in a row, operations are
+    committed one at a time, and those which still fail are logged 
+    and parked, in 'parked'. Failures which may pass, LockError and
+    OSError (a full disk, say), are only retried.
+    Messages are (need_index, op, args), where op is a write method
+    of Manager, or 'flush'.
+
+    @param needs Need classes served. Default is all Need classes.
+    @param address Unix socket path. Default is writer_address().
+    @param max_pending operations held for an index before commit
+    @param max_age seconds idle before held operations are committed
+    '''
+    ops = ('add', 'merge', 'delete', 'delete_when', 'bulk_add', 'flush')
+    max_failures = 3
+    retry_backoff = 1.0
+    retry_backoff_max = 60.0
+
+    def __init__(self, needs=None, address=None, max_pending=500, max_age=1.0):
+        if (needs is None):
+            from .models import need_classes
+            needs = need_classes
+        self.needs = {need._meta.need_index : need for need in needs}
+        self.address = address or writer_address()
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.queue = queue.Queue()
+        self.managers = {}
+        self.listener = None
+        self.errors = 0
+        # map of index -> (failures in a row, time of next try)
+        self.failures = {}
+        # list of (index, operation, error), for operations given up
+        self.parked = []
+        self._stopping = False
+
+    def _manager(self, need_index):
+        manager = self.managers.get(need_index)
+        if (manager is None):
+            opts = self.needs[need_index]._meta
+            # the service decides when to flush, on its own thread
+            buffered = partial(BufferedManager, max_pending=None, max_age=None)
+            if (opts.shards > 1):
+                manager = ShardedManager(shard_class=buffered)
+            else:
+                manager = buffered()
+            manager.contribute_to_class(opts)
+            self.managers[need_index] = manager
+        return manager
+
+    def apply(self, message):
+        '''
+        Apply one operation.
+        '''
+        need_index, op, args = message
+        if (op not in self.ops):
+            raise ValueError("Unknown writer operation '{0}'".format(op))
+        manager = self._manager(need_index)
+        if (op == 'flush'):
+            self._flush(manager, force=True)
+        elif (op == 'bulk_add'):
+            # held in order with the other operations
+            for data in args[0]:
+                manager.add(data)
+        else:
+            getattr(manager, op)(*args)
+        for m in manager.index_managers():
+            if (m.pending() >= self.max_pending):
+                self._flush_index(m)
+
+    def _flush_index(self, m, force=False):
+        index = m._need_index
+        failures, retry_at = self.failures.get(index, (0, 0))
+        if (failures and not force and time.monotonic() < retry_at):
+            return
+        try:
+            if (failures >= self.max_failures):
+                for operation, error in m.flush_each():
+                    logger.error('Writer parked %s on index %s: %r', operation, index, error)
+                    self.parked.append((index, operation, error))
+            else:
+                m.flush()
+        except Exception as e:
+            self.errors += 1
+            failures += 1
+            pause = min(self.retry_backoff * 2 ** (failures - 1), self.retry_backoff_max)
+            self.failures[index] = (failures, time.monotonic() + pause)
+            if (isinstance(e, (LockError, OSError))):
+                logger.warning('Writer commit on index %s failed, retry in %s seconds: %r', index, pause, e)
+            else:
+                logger.exception('Writer commit on index %s failed, retry in %s seconds', index, pause)
+            return
+        self.failures.pop(index, None)
+
+    def _flush(self, manager, force=False):
+        for m in manager.index_managers():
+            self._flush_index(m, force)
+
+    def flush(self, force=False):
+        '''
+        Commit all held operations. Failures are logged, not raised.
+        
+        @param force try indexes which are pausing after a failure
+        '''
+        for manager in self.managers.values():
+            self._flush(manager, force)
+
+    def _receive(self, conn):
+        with conn:
+            while (not self._stopping):
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                self.queue.put(message)
+
+    def _accept(self):
+        while (not self._stopping):
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # closed, or a client failed authentication
+                if (self.listener is None or self._stopping):
+                    return
+                continue
+            threading.Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def listen(self):
+        if (os.path.exists(self.address)):
+            # left by a service which did not close
+            os.unlink(self.address)
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=writer_authkey())
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def run(self):
+        '''
+        Apply queued operations, until stop().
+        '''
+        flushed = time.monotonic()
+        while (True):
+            try:
+                message = self.queue.get(timeout=self.max_age)
+            except queue.Empty:
+                message = False
+            if (message is None):
+                break
+            if (message):
+                try:
+                    self.apply(message)
+                except Exception:
+                    self.errors += 1
+                    logger.exception('Writer operation failed: %.200r', message)
+            # commit when idle, and at intervals under steady load
+            if ((message is False) or (time.monotonic() - flushed >= self.max_age)):
+                self.flush()
+                flushed = time.monotonic()
+        self.flush(force=True)
+
+    def serve_forever(self):
+        self.listen()
+        try:
+            self.run()
+        finally:
+            self.close()
+            # interrupted runs hold writes
+            self.flush(force=True)
+
+    def stop(self):
+        '''
+        Stop run(), after operations already queued.
+        '''
+        self._stopping = True
+        self.queue.put(None)
+
+    def close(self):
+        self._stopping = True
+        listener = self.listener
+        self.listener = None
+        if (listener is not None):
+            listener.close()